@@ -1,6 +1,7 @@
 import atexit
 
 from cpython cimport bool
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
 
 from libc.stddef cimport ptrdiff_t
 
@@ -147,7 +148,7 @@ cdef extern from "enet/enet.h":
         size_t nameLength)
 
     # Packet functions
-    ENetPacket* enet_packet_create(char *dataContents, size_t dataLength, 
+    ENetPacket* enet_packet_create(void *dataContents, size_t dataLength, 
         enet_uint32 flags)
     void enet_packet_destroy(ENetPacket *packet)
     int enet_packet_resize(ENetPacket *packet, size_t dataLength)
@@ -310,7 +311,8 @@ cdef class Packet:
 
     ATTRIBUTES
 
-        str data        Contains the data for the packet.
+        str data        Contains the data for the packet. It can be created
+                        from any object with the buffer interface.
         int flags       Flags modifying delivery of the Packet:
 
             enet.PACKET_FLAG_RELIABLE Packet must be received by the target peer
@@ -338,8 +340,12 @@ cdef class Packet:
     cdef bool sent
 
     def __init__(self, data=None, flags=0):
+        cdef Py_buffer buffer
         if data is not None:
-            self._enet_packet = enet_packet_create(data, len(data), flags)
+            PyObject_GetBuffer(data, &buffer, PyBUF_SIMPLE)
+            self._enet_packet = enet_packet_create(buffer.buf, buffer.len,
+                                                   flags)
+            PyBuffer_Release(&buffer)
 
         # This will get set to True when a peer.send() is called with the Packet
         # to ensure we don't try to destroy this packet as ENET will handle that
@@ -955,6 +961,31 @@ cdef class Host:
                 packet.sent = True
                 enet_host_broadcast(self._enet_host, channelID, packet._enet_packet)
 
+    def multicast(self, channelID, Packet packet, peers):
+        """
+        multicast (int channelID, Packet packet, list peers)
+
+        Queues a packet to be sent to each of the given peers. This is the
+        same as calling peer.send() for each of them, but the loop runs in C.
+
+        returns the number of peers the packet was queued for
+        """
+
+        cdef Peer peer
+        cdef enet_uint8 channel = channelID
+        cdef int count = 0
+        if not packet.is_valid():
+            return 0
+        for peer in peers:
+            if peer is None or not peer._enet_peer:
+                continue
+            if enet_peer_send(peer._enet_peer, channel,
+                              packet._enet_packet) == 0:
+                count += 1
+        if count:
+            packet.sent = True
+        return count
+
     def compress_with_range_coder(self):
         """
         Sets the packet compressor the host should use to the default range coder
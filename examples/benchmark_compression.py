@@ -0,0 +1,52 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Times encoding and compressing a map with 1, 2, 4 and 8 workers. Run it from
+this directory, optionally with the path of a .vxl file (defaults to
+../data/sinc0.vxl).
+"""
+
+import sys
+import time
+import zlib
+from pyspades.vxl import VXLData
+from pyspades.compression import compress_map, encode_map
+
+def bench(name, func, count = 5):
+    value = func() # warm up the thread pool
+    start = time.time()
+    for _ in xrange(count):
+        value = func()
+    dt = (time.time() - start) / count
+    print '%-28s %8.2f ms' % (name, dt * 1000.0)
+    return value
+
+path = '../data/sinc0.vxl'
+if len(sys.argv) > 1:
+    path = sys.argv[1]
+map = VXLData(open(path, 'rb'))
+data = map.generate()
+
+for workers in (1, 2, 4, 8):
+    value = bench('encode, %s workers' % workers,
+        lambda: encode_map(map, workers))
+    assert value == data
+    value = bench('compress, %s workers' % workers,
+        lambda: compress_map(map, workers))
+    assert zlib.decompress(value) == data
+    print '%-28s %8.2f kb' % ('compressed size', len(value) / 1024.0)
@@ -0,0 +1,134 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Times the hot VXLData paths on a map. Run it from this directory, optionally
+with the path of a .vxl file (defaults to ../data/sinc0.vxl).
+"""
+
+import sys
+import time
+import random
+from pyspades.vxl import VXLData
+
+def bench(name, func, count = 1):
+    start = time.time()
+    for _ in xrange(count):
+        value = func()
+    dt = (time.time() - start) / count
+    print '%-28s %8.2f ms' % (name, dt * 1000.0)
+    return value
+
+path = '../data/sinc0.vxl'
+if len(sys.argv) > 1:
+    path = sys.argv[1]
+data = open(path, 'rb').read()
+
+class FileData(object):
+    def read(self):
+        return data
+
+map = bench('load', lambda: VXLData(FileData()), 5)
+bench('copy', map.copy, 5)
+bench('encode', map.generate, 5)
+
+def generator():
+    generator = map.get_generator()
+    while generator.get_data(1024):
+        pass
+
+bench('encode (generator)', generator, 5)
+
+random.seed(0)
+points = [(random.randrange(512), random.randrange(512))
+    for _ in xrange(100000)]
+
+def get_z():
+    for x, y in points:
+        map.get_z(x, y)
+
+bench('get_z x 100000', get_z)
+
+def get_height():
+    for x, y in points:
+        map.get_height(x, y)
+
+bench('get_height x 100000', get_height)
+bench('get_overview', map.get_overview, 5)
+bench('get_layers', map.get_layers, 5)
+
+# connectivity checks on a copy of the map: a grounded surface voxel next to
+# each point, and a hanging 32x32 platform that gets cut loose
+
+test_map = map.copy()
+surface = [(x, y, test_map.get_z(x, y)) for (x, y) in points[:20000]]
+
+def check_grounded():
+    for x, y, z in surface:
+        test_map.check_node(x, y, z)
+
+bench('check_node x 20000', check_grounded)
+
+def build_platform():
+    z = test_map.get_z(256, 256) - 10
+    for i in xrange(10):
+        test_map.set_point(256, 256, z + i, (0, 0, 0))
+    for x in xrange(256, 288):
+        for y in xrange(256, 288):
+            test_map.set_point(x, y, z, (0, 0, 0))
+    return z
+
+def cut_platform():
+    z = build_platform()
+    test_map.destroy_point(256, 256, z + 1)
+
+bench('build + destroy platform', cut_platform, 10)
+
+# a large player build: a 128x128 floor 12 blocks above the ground, held up
+# by a single pillar in one corner. shooting blocks out of the middle of the
+# floor used to search all the way through it to the pillar, and cutting
+# the pillar collapses the whole floor.
+
+def build_floor():
+    floor_map = map.copy()
+    x1, y1 = 192, 192
+    z = min(floor_map.get_z(x, y) for x in xrange(x1, x1 + 128)
+        for y in xrange(y1, y1 + 128)) - 12
+    for pillar_z in xrange(z + 1, floor_map.get_z(x1, y1)):
+        floor_map.set_point(x1, y1, pillar_z, (0, 0, 0))
+    for x in xrange(x1, x1 + 128):
+        for y in xrange(y1, y1 + 128):
+            floor_map.set_point(x, y, z, (0, 0, 0))
+    return floor_map, x1, y1, z
+
+floor_map, floor_x, floor_y, floor_z = build_floor()
+holes = [(floor_x + random.randrange(8, 120), floor_y + random.randrange(8, 120))
+    for _ in xrange(200)]
+
+def shoot_floor():
+    for x, y in holes:
+        floor_map.destroy_point(x, y, floor_z)
+
+bench('shoot floor x 200', shoot_floor)
+
+def cut_pillar():
+    test_floor, x, y, z = build_floor()
+    start = time.time()
+    test_floor.destroy_point(x, y, z + 1)
+    return time.time() - start
+
+print '%-28s %8.2f ms' % ('cut floor pillar', cut_pillar() * 1000.0)
@@ -692,7 +692,7 @@ def change_planned_map(connection, *pre_maps):
         return 'Invalid map name'
     
     map = maps[0]
-    protocol.planned_map = check_rotation([map])[0]
+    protocol.set_planned_map(check_rotation([map])[0])
     protocol.send_chat('%s changed next map to %s' % (name, map), irc = True)
 
 @name('rotation')
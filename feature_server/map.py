@@ -16,13 +16,31 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from pyspades.vxl import VXLData
+from pyspades import mapmaker
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 
 import os
 import imp
 import math
+import mmap
 import random
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
 
 DEFAULT_LOAD_DIR = './maps'
+DEFAULT_CACHE_SIZE = 128 * 1024 * 1024
+GENERATED_DIR = 'generated'
+MAX_GENERATED_MAPS = 32
+
+# maps are loaded on pool threads as well as the reactor thread, but the map
+# generators keep state in globals and the caches below are shared, so only
+# one map is loaded at a time. waiting on the generator process is the
+# exception, so other maps can be loaded meanwhile.
+load_lock = threading.Lock()
 
 class MapNotFound(Exception):
     def __init__(self, map):
@@ -43,26 +61,172 @@ def check_rotation(maps, load_dir = DEFAULT_LOAD_DIR):
             raise MapNotFound(map)
     return infos
 
+def load_snapshot(filename, source = None):
+    """Returns the map in the snapshot file, or None if it is missing, older
+    than the source file (if given) or invalid."""
+    try:
+        if (source is not None and
+        os.path.getmtime(filename) < os.path.getmtime(source)):
+            return None
+        fp = open(filename, 'rb')
+    except EnvironmentError:
+        return None
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        fp.close()
+        return None
+    map = VXLData()
+    try:
+        map.load_snapshot(data)
+    except ValueError:
+        map = None
+    data.close()
+    fp.close()
+    return map
+
+def save_snapshot(map, filename):
+    # write to a temporary file first, so a server starting at the same time
+    # never sees half a snapshot
+    temp_filename = filename + '.tmp'
+    try:
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(temp_filename, 'wb').write(map.get_snapshot())
+        if os.path.isfile(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+    except EnvironmentError:
+        return False
+    return True
+
+class MapCache(object):
+    """Keeps pristine copies of loaded maps, so maps that come up again are
+    handed out as copy-on-write copies instead of being loaded again. Once
+    the maps take up more than max_size bytes, the least recently used ones
+    are dropped."""
+    def __init__(self, max_size = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.maps = OrderedDict()
+    
+    def get(self, key):
+        """Returns a copy of the map stored under key, or None"""
+        item = self.maps.pop(key, None)
+        if item is None:
+            return None
+        self.maps[key] = item
+        return item[0].copy()
+    
+    def add(self, key, map):
+        """Stores a copy of map under key"""
+        size = map.get_memory_size()
+        if size > self.max_size:
+            return
+        self.remove(key)
+        self.maps[key] = (map.copy(), size)
+        self.size += size
+        while self.size > self.max_size:
+            self.remove(next(iter(self.maps)))
+    
+    def remove(self, key):
+        item = self.maps.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+    
+    def clear(self):
+        self.maps.clear()
+        self.size = 0
+
+map_cache = MapCache()
+
+# generated maps are made in a separate process, so generating never holds
+# up the server. the results are kept on disk as snapshots, keyed by the map
+# name, seed and a hash of the map script. without fork, the worker would
+# have to import run.py again, so maps are generated in-process there.
+
+use_generator_process = hasattr(os, 'fork')
+generator_pool = None
+
+def start_generator_pool():
+    """Starts the map generator process. It is forked from the server, so
+    this has to be called before the reactor runs or any sockets are open."""
+    global generator_pool
+    if use_generator_process and generator_pool is None:
+        generator_pool = multiprocessing.Pool(1)
+
+def run_gen_script(gen_script, name, seed):
+    # map scripts draw from the generator in mapmaker, which nothing else
+    # uses, so the map for a seed is the same whatever the server is doing
+    mapmaker.random.seed(seed)
+    return gen_script(name, seed)
+
+def generate_map(name, filename, seed, snapshot_filename):
+    """Runs the map script in filename for seed in the generator process
+    and saves the map to snapshot_filename. If it cannot be saved, the
+    snapshot is returned instead."""
+    info = imp.load_source(name, filename)
+    # the process has the random module to itself, so older scripts that
+    # use it directly get the same map for a seed as well
+    random.seed(seed)
+    map = run_gen_script(info.gen_script, name, seed)
+    if save_snapshot(map, snapshot_filename):
+        return None
+    return map.get_snapshot()
+
+def prune_generated(directory, count = MAX_GENERATED_MAPS):
+    # remove all but the most recently used generated maps
+    try:
+        names = [os.path.join(directory, name)
+            for name in os.listdir(directory) if name.endswith('.snapshot')]
+        names.sort(key = os.path.getmtime, reverse = True)
+        for name in names[count:]:
+            os.remove(name)
+    except EnvironmentError:
+        pass
+
+# map metadata modules, by filename. they are executed again when the file
+# changes.
+info_cache = {}
+
+def load_info(name, filename):
+    try:
+        key = os.path.getmtime(filename)
+    except OSError:
+        return None
+    item = info_cache.get(filename, None)
+    if item is None or item[0] != key:
+        try:
+            info = imp.load_source(name, filename)
+        except IOError:
+            info = None
+        item = info_cache[filename] = (key, info)
+    return item[1]
+
 class Map(object):
+    """Loads the map for rot_info, generating it if needed. Generating can
+    take a while, so on the reactor thread this is only done before the
+    reactor runs, and maps are loaded with MapPrefetch after that."""
     def __init__(self, rot_info, load_dir = DEFAULT_LOAD_DIR):
-        self.load_information(rot_info, load_dir)
-        
-        if self.gen_script:
-            self.name = '%s #%s' % (rot_info.name, rot_info.get_seed())
-            print "Generating map '%s'..." % self.name
-            random.seed(rot_info.get_seed())
-            self.data = self.gen_script(rot_info.name, rot_info.get_seed())
-        else:
-            print "Loading map '%s'..." % self.name
-            self.load_vxl(rot_info, load_dir)
+        with load_lock:
+            self.load_information(rot_info, load_dir)
+            
+            if self.gen_script:
+                seed = rot_info.get_seed()
+                self.name = '%s #%s' % (rot_info.name, seed)
+                self.load_generated(rot_info, seed)
+            else:
+                print "Loading map '%s'..." % self.name
+                self.load_vxl(rot_info, load_dir)
+
+        if self.data is None:
+            self.generate(rot_info, seed)
 
         print 'Map loaded successfully.'
 
     def load_information(self, rot_info, load_dir):
-        try:
-            info = imp.load_source(rot_info.name, rot_info.get_meta_filename())
-        except IOError:
-            info = None
+        info = load_info(rot_info.name, rot_info.get_meta_filename())
         self.info = info
         self.rot_info = rot_info
         self.gen_script = getattr(info, 'gen_script', None)
@@ -91,13 +255,102 @@ class Map(object):
             protocol, connection = self.script(protocol, connection, config)
         return protocol, connection
 
+    def get_generated_key(self, rot_info, seed):
+        filename = rot_info.get_meta_filename()
+        return (filename, os.path.getmtime(filename), seed)
+
+    def load_generated(self, rot_info, seed):
+        # leaves data at None if the map has not been generated yet
+        key = self.get_generated_key(rot_info, seed)
+        self.data = map_cache.get(key)
+        if self.data is not None:
+            return
+        snapshot_filename = rot_info.get_generated_filename(seed)
+        self.data = load_snapshot(snapshot_filename)
+        if self.data is not None:
+            # mark it as recently used
+            try:
+                os.utime(snapshot_filename, None)
+            except OSError:
+                pass
+            map_cache.add(key, self.data)
+
+    def generate(self, rot_info, seed):
+        print "Generating map '%s'..." % self.name
+        filename = rot_info.get_meta_filename()
+        snapshot_filename = rot_info.get_generated_filename(seed)
+        if generator_pool is not None:
+            data = generator_pool.apply(generate_map, (rot_info.name,
+                filename, seed, snapshot_filename))
+            with load_lock:
+                if data is None:
+                    self.data = load_snapshot(snapshot_filename)
+                    prune_generated(os.path.dirname(snapshot_filename))
+                else:
+                    self.data = VXLData()
+                    self.data.load_snapshot(data)
+                map_cache.add(self.get_generated_key(rot_info, seed),
+                    self.data)
+            return
+        with load_lock:
+            self.data = run_gen_script(self.gen_script, rot_info.name, seed)
+            if save_snapshot(self.data, snapshot_filename):
+                prune_generated(os.path.dirname(snapshot_filename))
+            map_cache.add(self.get_generated_key(rot_info, seed), self.data)
+
     def load_vxl(self, rot_info, load_dir):
+        filename = rot_info.get_map_filename(load_dir)
         try:
-            fp = open(rot_info.get_map_filename(load_dir), 'rb')
+            key = (filename, os.path.getmtime(filename), None)
         except OSError:
             raise MapNotFound(rot_info.name)
-        self.data = VXLData(fp)
-        fp.close()
+        self.data = map_cache.get(key)
+        if self.data is not None:
+            return
+        snapshot_filename = rot_info.get_snapshot_filename(load_dir)
+        self.data = load_snapshot(snapshot_filename, filename)
+        if self.data is None:
+            try:
+                fp = open(filename, 'rb')
+            except IOError:
+                raise MapNotFound(rot_info.name)
+            self.data = VXLData(fp)
+            fp.close()
+            save_snapshot(self.data, snapshot_filename)
+        map_cache.add(key, self.data)
+
+class MapPrefetch(object):
+    """Loads a map with get_map(rot_info) on a reactor pool thread"""
+    map = None
+    failure = None
+    done = False
+    
+    def __init__(self, rot_info, get_map):
+        self.rot_info = rot_info
+        self.waiting = []
+        deferToThread(get_map, rot_info).addBoth(self.loaded)
+    
+    def loaded(self, result):
+        self.done = True
+        if isinstance(result, Failure):
+            self.failure = result
+        else:
+            self.map = result
+        waiting = self.waiting
+        self.waiting = []
+        for deferred in waiting:
+            deferred.callback(result)
+    
+    def get(self):
+        """Returns a Deferred that fires with the loaded map once it is
+        done, or fails with the error from loading it"""
+        if self.failure is not None:
+            return fail(self.failure)
+        if self.done:
+            return succeed(self.map)
+        deferred = Deferred()
+        self.waiting.append(deferred)
+        return deferred
 
 class RotationInfo(object):
     seed = None
@@ -122,5 +375,36 @@ class RotationInfo(object):
     def get_meta_filename(self, load_dir = DEFAULT_LOAD_DIR):
         return os.path.join(load_dir, '%s.txt' % self.name)
     
+    def get_snapshot_filename(self, load_dir = DEFAULT_LOAD_DIR):
+        return os.path.join(load_dir, '%s.snapshot' % self.name)
+    
+    def get_generated_filename(self, seed, load_dir = DEFAULT_LOAD_DIR):
+        script = open(self.get_meta_filename(load_dir), 'rb').read()
+        script_hash = hashlib.md5(script).hexdigest()[:16]
+        return os.path.join(load_dir, GENERATED_DIR, '%s.%s.%s.snapshot' % (
+            self.name, seed, script_hash))
+    
     def __str__(self):
         return self.full_name
+
+if __name__ == '__main__':
+    # converts the given maps (or all maps in the load directory) to
+    # snapshots, so the server does not have to on first load
+    import sys
+    import glob
+    names = sys.argv[1:]
+    if not names:
+        names = [os.path.splitext(os.path.basename(path))[0]
+            for path in glob.glob(os.path.join(DEFAULT_LOAD_DIR, '*.vxl'))]
+    for name in names:
+        rot_info = RotationInfo(name)
+        filename = rot_info.get_map_filename()
+        if not os.path.isfile(filename):
+            print 'No such map: %s' % filename
+            continue
+        map = VXLData(open(filename, 'rb'))
+        snapshot_filename = rot_info.get_snapshot_filename()
+        if save_snapshot(map, snapshot_filename):
+            print 'Wrote %s' % snapshot_filename
+        else:
+            print 'Could not write %s' % snapshot_filename
@@ -86,11 +86,13 @@ if sys.version_info < (2, 7):
 import pyspades.debug
 from pyspades.server import (ServerProtocol, ServerConnection, position_data,
     grenade_packet, Team)
-from map import Map, MapNotFound, check_rotation
+from map import (Map, MapNotFound, MapPrefetch, check_rotation, map_cache,
+    start_generator_pool)
 from console import create_console
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.python.logfile import DailyLogFile
 from pyspades.web import getPage
 from pyspades.common import encode, decode, prettify_timespan
@@ -98,6 +100,7 @@ from pyspades.constants import *
 from pyspades.master import MAX_SERVER_NAME_SIZE, get_external_ip
 from pyspades.tools import make_server_identifier
 from pyspades.types import AttributeSet
+from pyspades.compression import DEFAULT_WORKERS
 from networkdict import NetworkDict, get_network
 from pyspades.exceptions import InvalidData
 from pyspades.bytes import NoDataLeft
@@ -516,6 +519,9 @@ class FeatureProtocol(ServerProtocol):
     identifier = None
 
     planned_map = None
+    planned_map_chosen = False
+    map_prefetch = None
+    loading_map = None
     
     map_info = None
     spawns = None
@@ -590,6 +596,10 @@ class FeatureProtocol(ServerProtocol):
         self.default_ban_time = config.get('default_ban_duration', 24*60)
         
         self.speedhack_detect = config.get('speedhack_detect', True)
+        self.map_workers = config.get('map_workers', DEFAULT_WORKERS)
+        if 'map_cache_size' in config:
+            # in megabytes
+            map_cache.max_size = config['map_cache_size'] * 1024 * 1024
         if config.get('user_blocks_only', False):
             self.user_blocks = set()
         self.set_god_build = config.get('set_god_build', False)
@@ -716,6 +726,7 @@ class FeatureProtocol(ServerProtocol):
             self.planned_map = self.map_rotator.next()
         map = self.planned_map
         self.planned_map = None
+        self.planned_map_chosen = False
         self.on_advance(map)
         if message is None:
             self.set_map_name(map)
@@ -728,10 +739,54 @@ class FeatureProtocol(ServerProtocol):
         return self.game_mode_name
     
     def set_map_name(self, rot_info):
+        """Switches to the map for rot_info. Once the reactor runs, the map
+        is loaded in the background and the current map stays up until it is
+        done."""
+        prefetch = self.map_prefetch
+        self.map_prefetch = None
+        if not reactor.running:
+            # nothing is waiting on the reactor yet, so the first map is
+            # loaded right away
+            try:
+                map_info = self.get_map(rot_info)
+            except MapNotFound, e:
+                return e
+            self.set_map_info(map_info)
+            return True
+        if prefetch is None or prefetch.rot_info is not rot_info:
+            prefetch = MapPrefetch(rot_info, Map)
+        self.loading_map = prefetch
+        prefetch.get().addCallbacks(self._map_loaded, self._map_load_failed,
+            callbackArgs = (prefetch,), errbackArgs = (prefetch,))
+        return True
+    
+    def _map_loaded(self, map_info, prefetch):
+        if prefetch is not self.loading_map:
+            return
+        self.loading_map = None
         try:
-            map_info = self.get_map(rot_info)
-        except MapNotFound, e:
-            return e
+            map_info = self.load_map(map_info)
+        except MapNotFound:
+            self.map_load_failed(prefetch.rot_info, Failure())
+            return
+        self.set_map_info(map_info)
+    
+    def _map_load_failed(self, failure, prefetch):
+        if prefetch is not self.loading_map:
+            return
+        self.loading_map = None
+        self.map_load_failed(prefetch.rot_info, failure)
+    
+    def map_load_failed(self, rot_info, failure):
+        message = 'Could not load map %s: %s' % (rot_info.full_name,
+            failure.getErrorMessage())
+        print message
+        self.irc_say(message)
+        if self.map_info is not None:
+            # keep playing the current map until the next rotation
+            self.set_time_limit(self.map_info.time_limit)
+    
+    def set_map_info(self, map_info):
         if self.map_info:
             self.on_map_leave()
         self.map_info = map_info
@@ -739,11 +794,41 @@ class FeatureProtocol(ServerProtocol):
         self.set_map(self.map_info.data)
         self.set_time_limit(self.map_info.time_limit)
         self.update_format()
+        if self.planned_map is None:
+            self.set_planned_map(self.map_rotator.next(), False)
         return True
     
     def get_map(self, rot_info):
         return Map(rot_info)
     
+    def load_map(self, map_info):
+        """Returns the map to switch to, given the plain map that was loaded
+        in the background. Scripts that override get_map (like savemap, which
+        reads the saved map) only get to run at the switch, so they see the
+        state from then. The plain map is in the map cache by that time."""
+        if self.get_map.im_func is FeatureProtocol.get_map.im_func:
+            return map_info
+        return self.get_map(map_info.rot_info)
+    
+    def set_planned_map(self, rot_info, chosen = True):
+        """Makes rot_info the next map and starts loading it in the
+        background, so the switch at the end of the round is instant. Only
+        the plain map file or generator is loaded ahead of time. chosen is
+        False for maps that only come from the rotation, which a new
+        rotation replaces."""
+        self.planned_map = rot_info
+        self.planned_map_chosen = chosen
+        prefetch = self.map_prefetch = MapPrefetch(rot_info, Map)
+        prefetch.get().addErrback(self._map_prefetch_failed, prefetch)
+    
+    def _map_prefetch_failed(self, failure, prefetch):
+        if prefetch is not self.map_prefetch:
+            return
+        message = 'Could not load next map %s: %s' % (
+            prefetch.rot_info.full_name, failure.getErrorMessage())
+        print message
+        self.irc_say(message)
+    
     def set_map_rotation(self, maps, now = True):
         try:
             maps = check_rotation(maps)
@@ -751,8 +836,14 @@ class FeatureProtocol(ServerProtocol):
             return e
         self.maps = maps
         self.map_rotator = self.map_rotator_type(maps)
+        if not self.planned_map_chosen:
+            # only a map picked by an admin or a vote outlasts the rotation
+            self.planned_map = None
+            self.map_prefetch = None
         if now:
             self.advance_rotation()
+        elif self.map_info is not None and self.planned_map is None:
+            self.set_planned_map(self.map_rotator.next(), False)
         return True
 
     def get_map_rotation(self):
@@ -1021,6 +1112,10 @@ interface = config.get('network_interface', '')
 if interface == '':
     interface = '*'
 
+# the generator process is forked from the server, so it has to be started
+# before the server opens any sockets
+start_generator_pool()
+
 protocol_instance = protocol_class(interface, config)
 print 'Started server...'
 
@@ -5,7 +5,7 @@ Maintainer: hompy
 """
 
 from twisted.internet.task import LoopingCall
-from pyspades.vxl import VXLData
+from pyspades.vxl import VXLData, unpack_diff
 from pyspades.contained import BlockAction, SetColor
 from pyspades.constants import *
 from pyspades.common import coordinates, make_color
@@ -147,60 +147,51 @@ def apply_script(protocol, connection, config):
         
         def create_rollback_generator(self, cur, new, start_x, start_y,
             end_x, end_y, ignore_indestructable):
-            surface = {}
+            surface = []
             block_action = BlockAction()
             block_action.player_id = 31
             set_color = SetColor()
             set_color.value = make_color(*NON_SURFACE_COLOR)
             set_color.player_id = 31
             self.send_contained(set_color, save = True)
-            old = cur.copy()
             check_protected = hasattr(protocol, 'protected')
-            for x in xrange(start_x, end_x):
-                block_action.x = x
-                for y in xrange(start_y, end_y):
-                    block_action.y = y
+            for row in xrange(start_x, end_x):
+                # each row is diffed right before it is rolled back, so blocks
+                # built while the rollback runs are undone as well
+                changes = unpack_diff(cur.diff(new, row, start_y, row + 1,
+                    end_y))
+                for change in changes:
+                    x, y, z, kind, color = change
                     if check_protected and self.is_protected(x, y, 0):
                         continue
-                    for z in xrange(63):
-                        action = None
-                        cur_solid = cur.get_solid(x, y, z)
-                        new_solid = new.get_solid(x, y, z)
-                        if cur_solid and not new_solid:
-                            if (not ignore_indestructable and
-                                self.is_indestructable(x, y, z)):
-                                continue
-                            else:
-                                action = DESTROY_BLOCK
-                                cur.remove_point(x, y, z)
-                        elif new_solid:
-                            new_is_surface = new.is_surface(x, y, z)
-                            if new_is_surface:
-                                new_color = new.get_color(x, y, z)
-                            if not cur_solid and new_is_surface:
-                                surface[(x, y, z)] = new_color
-                            elif not cur_solid and not new_is_surface:
-                                action = BUILD_BLOCK
-                                cur.set_point(x, y, z, NON_SURFACE_COLOR)
-                            elif cur_solid and new_is_surface:
-                                old_is_surface = old.is_surface(x, y, z)
-                                if old_is_surface:
-                                    old_color = old.get_color(x, y, z)
-                                if not old_is_surface or old_color != new_color:
-                                    surface[(x, y, z)] = new_color
-                                    action = DESTROY_BLOCK
-                                    cur.remove_point(x, y, z)
-                        if action is not None:
-                            block_action.z = z
-                            block_action.value = action
-                            self.send_contained(block_action, save = True)
-                            yield 1
+                    if kind == DIFF_SURFACE:
+                        surface.append(change)
+                        continue
+                    if kind == DIFF_DESTROY:
+                        if (not ignore_indestructable and
+                            self.is_indestructable(x, y, z)):
+                            continue
+                        action = DESTROY_BLOCK
+                        cur.remove_point(x, y, z)
+                    elif kind == DIFF_BUILD:
+                        action = BUILD_BLOCK
+                        cur.set_point(x, y, z, NON_SURFACE_COLOR)
+                    else:
+                        # DIFF_REPLACE: rebuilt with the right color below
+                        surface.append(change)
+                        action = DESTROY_BLOCK
+                        cur.remove_point(x, y, z)
+                    block_action.x = x
+                    block_action.y = y
+                    block_action.z = z
+                    block_action.value = action
+                    self.send_contained(block_action, save = True)
+                    yield 1
                 yield 0
             last_color = None
             block_action.value = BUILD_BLOCK
-            for pos, color in sorted(surface.iteritems(),
-                key = operator.itemgetter(1)):
-                x, y, z = pos
+            for x, y, z, kind, color in sorted(surface,
+                key = operator.itemgetter(4)):
                 packets_sent = 0
                 if color != last_color:
                     set_color.value = make_color(*color)
@@ -1 +1 @@
-"""Saves current map on shutdown (and optionally loads it again on startup)Maintainer: mat^2"""from twisted.internet import reactorfrom pyspades.vxl import VXLDataimport osdef get_name(map):    return './maps/%s.saved.vxl' % (map.rot_info.name)def apply_script(protocol, connection, config):    class MapSaveProtocol(protocol):        def __init__(self, *arg, **kw):            protocol.__init__(self, *arg, **kw)            reactor.addSystemEventTrigger('before', 'shutdown', self.save_map)                    def get_map(self, name):            map = protocol.get_map(self, name)            if config.get('load_saved_map', False):                cached_path = get_name(map)                if os.path.isfile(cached_path):                    map.data = VXLData(open(cached_path, 'rb'))            return map                def save_map(self):            open(get_name(self.map_info), 'wb').write(self.map.generate())    return MapSaveProtocol, connection
\ No newline at end of file
+"""Saves the current map (and optionally loads it again on startup)Every block change is appended to a journal next to the saved map by abackground thread. Every few minutes the map is checkpointed to a snapshot,which starts the journal over. The VXL is saved on shutdown and every fewminutes as well, from a copy of the map on the same thread. On startup,the snapshot is loaded and the journal replayed on top of it, so a crashonly loses the last few changes.Options:    load_saved_map: load the saved map on startup (default false)    map_checkpoint_interval: seconds between snapshots (default 300)    map_autosave_interval: seconds between VXL saves, 0 to only save on        shutdown (default 600)Maintainer: mat^2"""from twisted.internet import reactorfrom twisted.internet.task import LoopingCallfrom pyspades.vxl import VXLDatafrom pyspades.compression import encode_mapfrom map import load_snapshot, save_snapshotfrom Queue import Queueimport threadingimport tracebackimport structimport timeimport os# time, player id, kind and change count, followed by the changesRECORD = struct.Struct('<dBBI')# x, y, z and colorCHANGE = struct.Struct('<HHBBBB')BUILD_CHANGE, DESTROY_CHANGE, COLLAPSE_CHANGE = xrange(3)NO_PLAYER = 255CHECKPOINT_INTERVAL = 300.0AUTOSAVE_INTERVAL = 600.0def get_name(map):    return './maps/%s.saved.vxl' % (map.rot_info.name)def get_snapshot_name(map):    return './maps/%s.saved.snapshot' % (map.rot_info.name)def get_journal_name(map):    return './maps/%s.saved.journal' % (map.rot_info.name)def get_old_journal_name(map):    return get_journal_name(map) + '.old'def read_journal(filename):    """Yields (time, player_id, kind, changes) for each record in the    journal. A record that was cut short by a crash ends the journal."""    try:        data = open(filename, 'rb').read()    except EnvironmentError:        return    offset = 0    while offset + RECORD.size <= len(data):        timestamp, player_id, kind, count = RECORD.unpack_from(data, offset)        offset += RECORD.size        end = offset + count * CHANGE.size        if end > len(data):            return        changes = [CHANGE.unpack_from(data, index)            for index in xrange(offset, end, CHANGE.size)]        offset = end        if player_id == NO_PLAYER:            player_id = None        yield timestamp, player_id, kind, changesdef replay_journal(map, filename):    for _, _, kind, changes in read_journal(filename):        if kind == BUILD_CHANGE:            for x, y, z, r, g, b in changes:                map.set_point(x, y, z, (r, g, b))        else:            for x, y, z, _, _, _ in changes:                map.remove_point(x, y, z)def load_saved_map(map):    """Loads the saved state of map into map.data. Returns True if it was    loaded from a snapshot and journal, so the journal can be kept."""    data = load_snapshot(get_snapshot_name(map))    if data is not None:        # the old journal is only left behind if the last checkpoint failed,        # and its changes come before the current journal        replay_journal(data, get_old_journal_name(map))        replay_journal(data, get_journal_name(map))        map.data = data        return True    filename = get_name(map)    if os.path.isfile(filename):        map.data = VXLData(open(filename, 'rb'))    return Falseclass JournalWriter(object):    """Runs file operations in order on a background thread"""    def __init__(self):        self.queue = Queue()        self.thread = threading.Thread(target = self.run)        self.thread.daemon = True        self.thread.start()    def put(self, func, *arg):        self.queue.put((func, arg))    def is_idle(self):        return self.queue.empty()    def run(self):        while True:            item = self.queue.get()            if item is None:                break            func, arg = item            try:                func(*arg)            except EnvironmentError, e:                print 'Could not save map: %s' % e            except Exception:                # keep the thread alive, or every later write would be                # queued up and lost                print 'Could not save map:'                traceback.print_exc()    def stop(self):        self.queue.put(None)        self.thread.join()class MapJournal(object):    """Records the changes to a map in its journal. Changes made while    handling a player's packet or grenade are written as one batch for that    player, everything else is written right away."""    player_id = NO_PLAYER    batch = False    checkpointing = False    checkpoint_pending = False    autosaving = False    closed = False    file = None    def __init__(self, writer, map, map_info, keep = False):        self.writer = writer        self.map = map        self.filename = get_journal_name(map_info)        self.old_filename = get_old_journal_name(map_info)        self.snapshot_filename = get_snapshot_name(map_info)        self.vxl_filename = get_name(map_info)        self.changes = []        self.removed = set()        if not keep:            writer.put(self.reset)        map.add_observer(self.on_change)        self.checkpoint()    def begin(self, player_id):        if player_id is None:            player_id = NO_PLAYER        self.player_id = player_id        self.batch = True    def end(self):        self.flush()        self.batch = False        self.player_id = NO_PLAYER    def on_change(self, map, changes):        if changes is None:            # the whole map was replaced or changed too much to list, which            # only a snapshot can record            self.changes = []            self.removed.clear()            self.checkpoint()            return        self.changes.extend(changes)        if not self.batch:            self.flush()    def flush(self):        if not self.changes:            self.removed.clear()            return        get_color = self.map.get_color        entries = ([], [], [])        seen = set()        for point in self.changes:            if point in seen:                continue            seen.add(point)            x, y, z = point            color = get_color(x, y, z)            if color is not None:                entries[BUILD_CHANGE].append(CHANGE.pack(x, y, z, *color))            elif self.batch and point not in self.removed:                entries[COLLAPSE_CHANGE].append(CHANGE.pack(x, y, z, 0, 0, 0))            else:                entries[DESTROY_CHANGE].append(CHANGE.pack(x, y, z, 0, 0, 0))        self.changes = []        self.removed.clear()        now = time.time()        data = []        for kind, kind_entries in enumerate(entries):            if not kind_entries:                continue            data.append(RECORD.pack(now, self.player_id, kind,                len(kind_entries)))            data.extend(kind_entries)        self.writer.put(self.write, ''.join(data))    def checkpoint(self, save_vxl = False, workers = None):        if self.closed:            return        if self.checkpointing and not save_vxl:            # the map may have been replaced since the copy being saved was            # taken, so another snapshot follows once it is done            self.checkpoint_pending = True            return        self.checkpoint_pending = False        self.flush()        self.checkpointing = True        self.writer.put(self.rotate)        self.writer.put(self.save, self.map.copy(), save_vxl, workers)    def checkpoint_done(self):        self.checkpointing = False        if self.checkpoint_pending:            self.checkpoint()    def autosave(self, workers = None):        if self.closed or self.autosaving:            return        self.autosaving = True        self.writer.put(self.autosave_vxl, self.map.copy(), workers)    def close(self, save_vxl = False, workers = None):        if self.closed:            return        self.map.remove_observer(self.on_change)        self.checkpoint(save_vxl, workers)        self.closed = True        self.writer.put(self.close_file)    # writer thread    def write(self, data):        if self.file is None:            self.file = open(self.filename, 'ab')        self.file.write(data)        if self.writer.is_idle():            self.file.flush()    def close_file(self):        if self.file is not None:            self.file.close()            self.file = None    def reset(self):        self.close_file()        for filename in (self.filename, self.old_filename):            if os.path.isfile(filename):                os.remove(filename)    def rotate(self):        # the changes so far are in the snapshot about to be saved, so they        # move to the old journal, which is removed once it is saved        self.close_file()        if not os.path.isfile(self.filename):            return        if os.path.isfile(self.old_filename):            # the last checkpoint failed, so its changes are still needed            old_file = open(self.old_filename, 'ab')            old_file.write(open(self.filename, 'rb').read())            old_file.close()            os.remove(self.filename)        else:            os.rename(self.filename, self.old_filename)    def save(self, map, save_vxl, workers):        try:            if (save_snapshot(map, self.snapshot_filename) and            os.path.isfile(self.old_filename)):                os.remove(self.old_filename)            if save_vxl:                self.save_vxl(map, workers)        finally:            reactor.callFromThread(self.checkpoint_done)    def autosave_vxl(self, map, workers):        try:            self.save_vxl(map, workers)        finally:            self.autosaving = False    def save_vxl(self, map, workers):        start = time.time()        data = encode_map(map, workers)        # renaming the finished file keeps a crash from leaving half a map        temp_filename = self.vxl_filename + '.tmp'        open(temp_filename, 'wb').write(data)        if os.name == 'nt' and os.path.isfile(self.vxl_filename):            os.remove(self.vxl_filename)        os.rename(temp_filename, self.vxl_filename)        print 'Saved %s (%s kb) in %.2f s' % (self.vxl_filename,            len(data) // 1024, time.time() - start)def apply_script(protocol, connection, config):    checkpoint_interval = config.get('map_checkpoint_interval',        CHECKPOINT_INTERVAL)    autosave_interval = config.get('map_autosave_interval', AUTOSAVE_INTERVAL)    load_saved = config.get('load_saved_map', False)    class MapSaveConnection(connection):        def loader_received(self, loader):            return self.record_batch(connection.loader_received, loader)        def grenade_exploded(self, grenade):            return self.record_batch(connection.grenade_exploded, grenade)        def record_batch(self, func, *arg):            journal = self.protocol.map_journal            if journal is None:                return func(self, *arg)            journal.begin(self.player_id)            try:                return func(self, *arg)            finally:                journal.end()        def on_block_removed(self, x, y, z):            journal = self.protocol.map_journal            if journal is not None:                journal.removed.add((x, y, z))            connection.on_block_removed(self, x, y, z)    class MapSaveProtocol(protocol):        map_journal = None        def __init__(self, *arg, **kw):            # the first map is set while the protocol is created            self.journal_writer = JournalWriter()            protocol.__init__(self, *arg, **kw)            self.checkpoint_loop = LoopingCall(self.checkpoint_map)            self.checkpoint_loop.start(checkpoint_interval, now = False)            self.autosave_loop = LoopingCall(self.autosave_map)            if autosave_interval:                self.autosave_loop.start(autosave_interval, now = False)            reactor.addSystemEventTrigger('before', 'shutdown', self.save_map)        def get_map(self, name):            map = protocol.get_map(self, name)            if load_saved:                map.journal_loaded = load_saved_map(map)            return map        def on_map_change(self, map):            if self.map_journal is not None:                self.map_journal.close()            self.map_journal = MapJournal(self.journal_writer, map,                self.map_info, getattr(self.map_info, 'journal_loaded', False))            protocol.on_map_change(self, map)        def checkpoint_map(self):            if self.map_journal is not None:                self.map_journal.checkpoint()        def autosave_map(self):            if self.map_journal is not None:                self.map_journal.autosave(self.map_workers)        def save_map(self):            if self.map_journal is not None:                self.map_journal.close(True, self.map_workers)            self.journal_writer.stop()    return MapSaveProtocol, MapSaveConnection
\ No newline at end of file
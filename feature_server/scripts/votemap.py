@@ -146,7 +146,7 @@ class VoteMap(object):
         else:
             self.protocol.send_chat('Mapvote ended. Next map will be: %s.' % 
                 result, irc = True)
-            self.protocol.planned_map = check_rotation([result])[0]
+            self.protocol.set_planned_map(check_rotation([result])[0])
         self.set_cooldown()
         
     def set_cooldown(self):
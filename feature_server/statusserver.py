@@ -15,17 +15,23 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet import reactor
-from twisted.web import server
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web import server, http
 from twisted.web.resource import Resource
 from string import Template
 import Image
 from jinja2 import Environment, PackageLoader
 import json
+import hashlib
 from cStringIO import StringIO
+from pyspades.vxl import TILE_SIZE
 
 STATUS_NAME = 'status.html'
-OVERVIEW_UPDATE_INTERVAL = 1 * 60 # 1 minute
+OVERVIEW_UPDATE_INTERVAL = 1.0 # seconds
+OVERVIEW_SIZE = 512
 
 class CommonResource(Resource):
     protocol = None
@@ -78,21 +84,85 @@ class StatusPage(CommonResource):
             
 
 class MapOverview(CommonResource):
+    """Serves the map overview as a PNG at /overview, and the tiles it is
+    made of at /overview/<x>/<y>. /overview/tiles lists the ETag of every
+    tile, so clients can fetch just the tiles that changed."""
+    
     def render_GET(self, request):
-        overview = self.parent.get_overview()
-        request.setHeader("content-type", 'png/image')
-        request.setHeader("content-length", str(len(overview)))
-        if request.method == "HEAD":
-            return ''
-        return overview
+        path = [part for part in request.postpath if part]
+        deferred = self.parent.update_overview(full = not path)
+        deferred.addCallback(self.send_overview, request, path)
+        deferred.addErrback(self.send_error, request)
+        return server.NOT_DONE_YET
     render_HEAD = render_GET
+    
+    def send_overview(self, result, request, path):
+        parent = self.parent
+        content_type = 'image/png'
+        if not path:
+            data, etag = parent.overview
+        elif path == ['tiles']:
+            tiles = dict(('%s,%s' % pos, etag)
+                for (pos, (data, etag)) in parent.tiles.iteritems())
+            data = json.dumps({'size' : TILE_SIZE, 'tiles' : tiles})
+            etag = get_etag(data)
+            content_type = 'application/json'
+        else:
+            try:
+                data, etag = parent.tiles[tuple(int(part) for part in path)]
+            except (ValueError, KeyError):
+                request.setResponseCode(http.NOT_FOUND)
+                request.finish()
+                return
+        request.setHeader("content-type", content_type)
+        if request.setETag(etag) == http.CACHED:
+            request.finish()
+            return
+        request.setHeader("content-length", str(len(data)))
+        if request.method != "HEAD":
+            request.write(data)
+        request.finish()
+    
+    def send_error(self, failure, request):
+        log.err(failure, 'Could not create map overview')
+        request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.finish()
+
+def get_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+def encode_image(image):
+    data = StringIO()
+    image.save(data, 'png')
+    return data.getvalue()
+
+def render_overview(map, tiles, image, encode_full):
+    """Draws the given tiles of the map onto image. Returns the tiles as
+    PNGs, and the whole image as one if encode_full is set."""
+    encoded = {}
+    for x, y in tiles:
+        x1 = x * TILE_SIZE
+        y1 = y * TILE_SIZE
+        data = map.get_overview(rgba = True, x1 = x1, y1 = y1,
+            x2 = x1 + TILE_SIZE, y2 = y1 + TILE_SIZE)
+        tile = Image.fromstring('RGBA', (TILE_SIZE, TILE_SIZE), data)
+        image.paste(tile, (x1, y1))
+        encoded[(x, y)] = encode_image(tile)
+    if encode_full:
+        return encoded, encode_image(image)
+    return encoded, None
 
 class StatusServerFactory(object):
     last_overview = None
     overview = None
+    overview_map = None
+    overview_calls = None
+    
     def __init__(self, protocol, config):
         self.env = Environment(loader = PackageLoader('web'))
         self.protocol = protocol
+        self.tiles = {}
+        self.image = Image.new('RGBA', (OVERVIEW_SIZE, OVERVIEW_SIZE))
         root = Resource()
         root.putChild('json', JSONPage(self))
         root.putChild('', StatusPage(self))
@@ -100,14 +170,54 @@ class StatusServerFactory(object):
         site = server.Site(root)
         protocol.listenTCP(config.get('port', 32886), site)
     
-    def get_overview(self):
+    def update_overview(self, full = False):
+        """Returns a Deferred that fires once the overview tiles, and with
+        full set the whole overview, are at most OVERVIEW_UPDATE_INTERVAL
+        old. Only the tiles written to since the last update are drawn
+        again. That happens on a thread, from a copy of the map, so the game
+        goes on meanwhile."""
+        deferred = Deferred()
+        if self.overview_calls is not None:
+            self.overview_calls.append((deferred, full))
+            return deferred
         current_time = reactor.seconds()
-        if (self.last_overview is None or 
+        map = self.overview_map
+        tiles = []
+        if (self.last_overview is None or
         current_time - self.last_overview > OVERVIEW_UPDATE_INTERVAL):
-            overview = self.protocol.map.get_overview(rgba = True)
-            image = Image.fromstring('RGBA', (512, 512), overview)
-            data = StringIO()
-            image.save(data, 'png')
-            self.overview = data.getvalue()
+            map = self.protocol.map.copy()
+            tiles = map.get_changed_tiles(self.overview_map)
+            if tiles:
+                self.overview = None
+            else:
+                self.overview_map = map
+                self.last_overview = current_time
+        encode_full = full and self.overview is None
+        if not tiles and not encode_full:
+            return succeed(None)
+        self.overview_calls = [(deferred, full)]
+        call = threads.deferToThread(render_overview, map, tiles, self.image,
+            encode_full)
+        call.addBoth(self.overview_rendered, map, current_time)
+        return deferred
+    
+    def overview_rendered(self, result, map, current_time):
+        calls = self.overview_calls
+        self.overview_calls = None
+        if isinstance(result, Failure):
+            for deferred, full in calls:
+                deferred.errback(result)
+            return
+        tiles, overview = result
+        for pos, data in tiles.iteritems():
+            self.tiles[pos] = (data, get_etag(data))
+        if overview is not None:
+            self.overview = (overview, get_etag(overview))
+        if map is not self.overview_map:
+            self.overview_map = map
             self.last_overview = current_time
-        return self.overview
\ No newline at end of file
+        for deferred, full in calls:
+            if full and self.overview is None:
+                self.update_overview(full).chainDeferred(deferred)
+            else:
+                deferred.callback(None)
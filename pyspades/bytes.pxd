@@ -29,7 +29,7 @@ cdef class ByteReader:
 cdef class ByteWriter:
     cdef void * stream
     
-    cdef void writeSize(self, char * data, int size)
+    cdef int writeSize(self, char * data, int size) except -1
     cpdef write(self, data)
     cpdef writeByte(self, int value, bint unsigned = ?)
     cpdef writeShort(self, int value, bint unsigned = ?, 
@@ -41,4 +41,5 @@ cdef class ByteWriter:
     cpdef writeString(self, value, int size = ?)
     cpdef pad(self, int bytes)
     cpdef rewind(self, int bytes)
-    cpdef size_t tell(self)
\ No newline at end of file
+    cpdef size_t tell(self)
+    cpdef reset(self)
\ No newline at end of file
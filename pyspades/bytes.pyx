@@ -19,6 +19,8 @@
 Reads/writes bytes
 """
 
+from cpython.buffer cimport PyBuffer_FillInfo
+
 cdef extern from "bytes_c.cpp":
     char read_byte(char * data)
     unsigned char read_ubyte(char * data)
@@ -31,16 +33,20 @@ cdef extern from "bytes_c.cpp":
     
     void * create_stream()
     void delete_stream(void * stream)
-    void write_byte(void * stream, char value)
-    void write_ubyte(void * stream, unsigned char value)
-    void write_short(void * stream, short value, int big_endian)
-    void write_ushort(void * stream, unsigned short value, int big_endian)
-    void write_int(void * stream, int value, int big_endian)
-    void write_uint(void * stream, unsigned int value, int big_endian)
-    void write_float(void * stream, double value, int big_endian)
-    void write_string(void * stream, char * data, size_t size)
-    void write(void * stream, char * data, size_t size)
+    int write_byte(void * stream, char value) except -1
+    int write_ubyte(void * stream, unsigned char value) except -1
+    int write_short(void * stream, short value, int big_endian) except -1
+    int write_ushort(void * stream, unsigned short value,
+        int big_endian) except -1
+    int write_int(void * stream, int value, int big_endian) except -1
+    int write_uint(void * stream, unsigned int value,
+        int big_endian) except -1
+    int write_float(void * stream, double value, int big_endian) except -1
+    int write_string(void * stream, char * data, size_t size) except -1
+    int write(void * stream, char * data, size_t size) except -1
     void rewind_stream(void * stream, int bytes)
+    void reset_stream(void * stream)
+    char * get_stream_data(void * stream)
     object get_stream(void * stream)
     size_t get_stream_size(void * stream)
     size_t get_stream_pos(void * stream)
@@ -161,8 +167,8 @@ cdef class ByteWriter:
     def __init__(self):
         self.stream = create_stream()
     
-    cdef void writeSize(self, char * data, int size):
-        write(self.stream, data, size)
+    cdef int writeSize(self, char * data, int size) except -1:
+        return write(self.stream, data, size)
     
     cpdef write(self, data):
         write(self.stream, data, len(data))
@@ -209,9 +215,22 @@ cdef class ByteWriter:
     cpdef size_t tell(self):
         return get_stream_pos(self.stream)
     
+    cpdef reset(self):
+        """Empties the writer, keeping its memory so it can be reused"""
+        reset_stream(self.stream)
+    
     def __str__(self):
         return get_stream(self.stream)
     
+    def __getbuffer__(self, Py_buffer * buffer, int flags):
+        # lets enet.Packet copy the data without going through a string.
+        # the buffer is only valid until the next write
+        PyBuffer_FillInfo(buffer, self, get_stream_data(self.stream),
+            get_stream_size(self.stream), 1, flags)
+    
+    def __releasebuffer__(self, Py_buffer * buffer):
+        pass
+    
     def __dealloc__(self):
         delete_stream(self.stream)
     
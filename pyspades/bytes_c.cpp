@@ -17,21 +17,58 @@
     along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 */
 
-#include <iostream>
-#include <sstream>
-#include <string>
+#include <stdlib.h>
+#include <string.h>
 #include "Python.h"
-using namespace std;
+
+// a growable buffer. writes go to pos, which can be moved back with
+// rewind_stream(), and size is the end of the furthest write
+struct Stream
+{
+    char * data;
+    size_t size, pos, capacity;
+};
 
 void * create_stream()
 {
-    stringstream * ss = new stringstream(stringstream::out | stringstream::binary);
-    return (void*)ss;
+    Stream * stream = new Stream;
+    stream->data = NULL;
+    stream->size = stream->pos = stream->capacity = 0;
+    return (void*)stream;
+}
+
+void delete_stream(void * stream)
+{
+    free(((Stream*)stream)->data);
+    delete (Stream*)stream;
 }
 
-void delete_stream(void * ss)
+// returns where to write the next size bytes, and moves past them. if the
+// stream cannot grow, it is left as it was, MemoryError is set and NULL is
+// returned, so the write functions below return -1.
+inline char * reserve_stream(void * stream, size_t size)
 {
-    delete (stringstream*)ss;
+    Stream * s = (Stream*)stream;
+    size_t end = s->pos + size;
+    if (end > s->capacity) {
+        size_t capacity = s->capacity * 2;
+        if (capacity < 64)
+            capacity = 64;
+        if (capacity < end)
+            capacity = end;
+        char * data = (char*)realloc(s->data, capacity);
+        if (data == NULL) {
+            PyErr_NoMemory();
+            return NULL;
+        }
+        s->data = data;
+        s->capacity = capacity;
+    }
+    char * out = s->data + s->pos;
+    s->pos = end;
+    if (end > s->size)
+        s->size = end;
+    return out;
 }
 
 /*
@@ -103,115 +140,137 @@ write methods
 
 // byte
 
-inline void write_byte(void * stream, char value)
+inline int write_byte(void * stream, char value)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->put(value);
+    char * out = reserve_stream(stream, 1);
+    if (out == NULL)
+        return -1;
+    out[0] = value;
+    return 0;
 }
 
-inline void write_ubyte(void * stream, unsigned char value)
+inline int write_ubyte(void * stream, unsigned char value)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->put((char)value);
+    return write_byte(stream, (char)value);
 }
 
 // short
 
-inline void write_short(void * stream, short value, int big_endian)
+inline int write_short(void * stream, short value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
+    char * out = reserve_stream(stream, 2);
+    if (out == NULL)
+        return -1;
     if (big_endian)
     {
-        ss->put((char)(value >> 8));
-        ss->put((char)value);
+        out[0] = (char)(value >> 8);
+        out[1] = (char)value;
     }
     else
     {
-        ss->put((char)value);
-        ss->put((char)(value >> 8));
+        out[0] = (char)value;
+        out[1] = (char)(value >> 8);
     }
+    return 0;
 }
 
-inline void write_ushort(void * stream, unsigned short value, 
-                         int big_endian)
+inline int write_ushort(void * stream, unsigned short value, 
+                        int big_endian)
 {
-    write_short(stream, (short)value, big_endian);
+    return write_short(stream, (short)value, big_endian);
 }
 
 // int
 
-inline void write_int(void * stream, int value, int big_endian)
+inline int write_int(void * stream, int value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
+    char * out = reserve_stream(stream, 4);
+    if (out == NULL)
+        return -1;
     if (big_endian)
     {
-        ss->put((char)(value >> 24));
-        ss->put((char)(value >> 16));
-        ss->put((char)(value >> 8));
-        ss->put((char)value);
+        out[0] = (char)(value >> 24);
+        out[1] = (char)(value >> 16);
+        out[2] = (char)(value >> 8);
+        out[3] = (char)value;
     }
     else
     {
-        ss->put((char)value);
-        ss->put((char)(value >> 8));
-        ss->put((char)(value >> 16));
-        ss->put((char)(value >> 24));
+        out[0] = (char)value;
+        out[1] = (char)(value >> 8);
+        out[2] = (char)(value >> 16);
+        out[3] = (char)(value >> 24);
     }
+    return 0;
 }
 
-inline void write_uint(void * stream, unsigned int value, 
-                               int big_endian)
+inline int write_uint(void * stream, unsigned int value, 
+                              int big_endian)
 {
-    write_int(stream, (int)value, big_endian);
+    return write_int(stream, (int)value, big_endian);
 }
 
 // float
 
-inline void write_float(void * stream, double value, int big_endian)
+inline int write_float(void * stream, double value, int big_endian)
 {
-    stringstream * ss = (stringstream*)stream;
-    char out[4];
-    _PyFloat_Pack4(value, (unsigned char *)&out, !big_endian);
-    ss->write(out, 4);
+    char * out = reserve_stream(stream, 4);
+    if (out == NULL)
+        return -1;
+    return _PyFloat_Pack4(value, (unsigned char *)out, !big_endian);
 }
 
-inline void write_string(void * stream, char * data, size_t size)
+inline int write_string(void * stream, char * data, size_t size)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->write(data, size);
-    ss->put(0);
+    char * out = reserve_stream(stream, size + 1);
+    if (out == NULL)
+        return -1;
+    memcpy(out, data, size);
+    out[size] = 0;
+    return 0;
 }
 
-inline void write(void * stream, char * data, size_t size)
+inline int write(void * stream, char * data, size_t size)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->write(data, size);
+    char * out = reserve_stream(stream, size);
+    if (out == NULL)
+        return -1;
+    memcpy(out, data, size);
+    return 0;
 }
 
 inline void rewind_stream(void * stream, int bytes)
 {
-    stringstream * ss = (stringstream*)stream;
-    ss->seekp(-bytes, stringstream::cur);
+    Stream * s = (Stream*)stream;
+    if (bytes < 0 || (size_t)bytes > s->pos)
+        return;
+    s->pos -= bytes;
+}
+
+// empties the stream, but keeps its memory for the next writes
+inline void reset_stream(void * stream)
+{
+    Stream * s = (Stream*)stream;
+    s->size = s->pos = 0;
 }
 
 inline size_t get_stream_size(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    return ss->str().length();
+    return ((Stream*)stream)->size;
 }
 
 inline size_t get_stream_pos(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    streampos pos = ss->tellp();
-    if (pos == (streampos)-1)
-        return 0;
-    return pos;
+    return ((Stream*)stream)->pos;
+}
+
+inline char * get_stream_data(void * stream)
+{
+    return ((Stream*)stream)->data;
 }
 
 inline PyObject * get_stream(void * stream)
 {
-    stringstream * ss = (stringstream*)stream;
-    const string tmp = ss->str();
-    return PyString_FromStringAndSize(tmp.c_str(), tmp.length());
+    Stream * s = (Stream*)stream;
+    return PyString_FromStringAndSize(s->data, s->size);
 }
\ No newline at end of file
@@ -239,14 +239,10 @@ void genland(unsigned int seed, MapData * map)
     for (y = 0, k = 0; y < VSID; y++) {
     for (x = 0; x < VSID; x++, k++) {
         height = buf[k].a;
-        for (z = 63; z > height; z--) {
-            map->geometry[get_pos(x, y, z)] = true;
-        }
-        map->geometry[get_pos(x, y, z)] = true;
+        z = min(height, 63);
+        set_column_solid(x, y, z, 63, map, true);
         lowest_z = get_lowest_height(x, y) + 1;
-        for (; z < lowest_z; z++) {
-            map->colors[get_pos(x, y, z)] = ((int*)&buf[k])[0];
-        }
+        set_column_color(x, y, z, lowest_z - 1, map, ((int*)&buf[k])[0]);
     }}
 
     return;
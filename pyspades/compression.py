@@ -0,0 +1,123 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encodes and compresses maps on several threads.
+
+The map is split into bands of rows. Each band is encoded and deflated on
+its own, and the bands are joined into a single zlib stream: every band but
+the last ends with a sync flush, which leaves the deflate stream on a byte
+boundary without ending it. VXLData.generate() and zlib both release the GIL,
+so the bands run in parallel.
+"""
+
+import zlib
+import struct
+from multiprocessing.pool import ThreadPool
+
+COMPRESSION_LEVEL = 9
+MAP_Y = 512
+ADLER_BASE = 65521
+
+# examples/benchmark_compression.py only shows a small gain from more
+# workers, so they are opt-in
+DEFAULT_WORKERS = 1
+
+pools = {}
+
+def get_pool(workers):
+    pool = pools.get(workers, None)
+    if pool is None:
+        pool = pools[workers] = ThreadPool(workers)
+    return pool
+
+def adler32_combine(adler1, adler2, length2):
+    """Returns the Adler-32 checksum of two strings joined together, given
+    the checksum of each and the length of the second."""
+    remainder = length2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder * sum1) % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xFFFF) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE -
+        remainder) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def get_header(level):
+    if level == zlib.Z_DEFAULT_COMPRESSION:
+        level = 6
+    if level < 2:
+        flags = 0
+    elif level < 6:
+        flags = 1 << 6
+    elif level == 6:
+        flags = 2 << 6
+    else:
+        flags = 3 << 6
+    # 32K window, deflate
+    method = 0x78
+    flags += (31 - ((method << 8) | flags) % 31) % 31
+    return chr(method) + chr(flags)
+
+def get_bands(workers):
+    count = min(MAP_Y, workers * 2)
+    size = (MAP_Y + count - 1) // count
+    return [(y, min(MAP_Y, y + size)) for y in xrange(0, MAP_Y, size)]
+
+def encode_band(arguments):
+    map, y1, y2 = arguments
+    return map.generate(y1, y2)
+
+def compress_band(arguments):
+    map, y1, y2, level, last = arguments
+    data = map.generate(y1, y2)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if last:
+        flush = zlib.Z_FINISH
+    else:
+        flush = zlib.Z_SYNC_FLUSH
+    value = compressor.compress(data) + compressor.flush(flush)
+    return value, zlib.adler32(data) & 0xFFFFFFFF, len(data)
+
+def encode_map(map, workers = None):
+    """Returns the map in VXL format, the same as map.generate()."""
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    if workers <= 1:
+        return map.generate()
+    arguments = [(map, y1, y2) for (y1, y2) in get_bands(workers)]
+    return ''.join(get_pool(workers).map(encode_band, arguments))
+
+def compress_map(map, workers = None, level = COMPRESSION_LEVEL):
+    """Returns the map in VXL format as a zlib stream. The map must not be
+    changed until this returns; pass a copy() when calling it from another
+    thread."""
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    if workers <= 1:
+        return zlib.compress(map.generate(), level)
+    bands = get_bands(workers)
+    last = bands[-1]
+    arguments = [(map, y1, y2, level, (y1, y2) == last)
+        for (y1, y2) in bands]
+    results = get_pool(workers).map(compress_band, arguments)
+    checksum = 1
+    data = [get_header(level)]
+    for value, band_checksum, length in results:
+        data.append(value)
+        checksum = adler32_combine(checksum, band_checksum, length)
+    data.append(struct.pack('>I', checksum))
+    return ''.join(data)
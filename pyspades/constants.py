@@ -21,6 +21,7 @@ RIFLE_WEAPON, SMG_WEAPON, SHOTGUN_WEAPON = xrange(3)
 TORSO, HEAD, ARMS, LEGS, MELEE = xrange(5)
 SPADE_TOOL, BLOCK_TOOL, WEAPON_TOOL, GRENADE_TOOL = xrange(4)
 BUILD_BLOCK, DESTROY_BLOCK, SPADE_DESTROY, GRENADE_DESTROY = xrange(4)
+DIFF_DESTROY, DIFF_BUILD, DIFF_SURFACE, DIFF_REPLACE = xrange(4)
 BLUE_FLAG, GREEN_FLAG, BLUE_BASE, GREEN_BASE = xrange(4)
 CHAT_ALL, CHAT_TEAM, CHAT_SYSTEM = xrange(3)
 (WEAPON_KILL, HEADSHOT_KILL, MELEE_KILL, GRENADE_KILL, FALL_KILL, 
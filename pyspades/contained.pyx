@@ -20,6 +20,9 @@ from pyspades.constants import *
 from pyspades.loaders cimport Loader
 from pyspades.bytes cimport ByteReader, ByteWriter
 
+cdef extern from "Python.h":
+    char * PyByteArray_AS_STRING(object bytearray)
+
 cdef inline float limit(float a):
     if a > 512.0:
         return 512.0
@@ -102,6 +105,8 @@ cdef class WorldUpdate(Loader):
     
     cdef public:
         list items
+        # if set, written as is instead of items, see world.write_world_update
+        bytearray data
     
     cpdef read(self, ByteReader reader):
         cdef list items = []
@@ -117,6 +122,9 @@ cdef class WorldUpdate(Loader):
     
     cpdef write(self, ByteWriter reader):
         reader.writeByte(self.id, True)
+        if self.data is not None:
+            reader.writeSize(PyByteArray_AS_STRING(self.data), len(self.data))
+            return
         cdef tuple item
         for item in self.items:
             (p_x, p_y, p_z), (o_x, o_y, o_z) = item
@@ -15,17 +15,26 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
-from vxl cimport VXLData, MapData
+from vxl cimport (VXLData, MapData, set_column_solid, set_column_color,
+    is_valid_column)
+from libc.math cimport sin
+cimport cpython.array as carray
 
 cdef extern from "classicgen_c.cpp":
     void genland(unsigned long seed, MapData * map)
 
 import array
-import random
 import math
 import sys
 from collections import deque
 cimport cython
+from random import Random
+
+cdef double PI = math.pi
+
+# map scripts draw from this generator rather than the random module, so the
+# server can use random while a map is generated without changing the map
+random = Random()
 
 def generate_classic(seed):
     cdef VXLData map = VXLData()
@@ -151,6 +160,10 @@ cdef class BiomeMap:
         
 @cython.final
 cdef class HeightMap:
+    """
+    A 512x512 map of heights (0.0-1.0) and colors. hmap and cmap are arrays
+    of floats and ints, which the methods below work on directly.
+    """
     cdef public int width
     cdef public int height
     cdef public object hmap
@@ -158,61 +171,94 @@ cdef class HeightMap:
     def __init__(self, height):
         self.width = 512
         self.height = 512
-        self.hmap = array.array('f',[height for n in xrange(0,
-                                    self.width*self.height)])
-        self.cmap = array.array('i',[<int>0xFF00FFFF for n in xrange(0,
-                                    self.width*self.height)])
-    cpdef inline double get(self, int x, int y):
-        return self.hmap[x+y*self.height]
+        self.hmap = array.array('f', [height]) * (self.width * self.height)
+        self.cmap = array.array('i', [<int>0xFF00FFFF]) * (self.width *
+                                                             self.height)
+    cdef inline float * get_heights(self):
+        return (<carray.array>self.hmap).data.as_floats
+    cdef inline int * get_colors(self):
+        return (<carray.array>self.cmap).data.as_ints
+    cdef inline int get_size(self):
+        return self.width * self.height
+    cdef inline int get_index(self, int x, int y) except -1:
+        """Index of (x, y), with the bounds of a Python list index"""
+        cdef int idx = x+y*self.height
+        cdef int size = self.get_size()
+        if idx < 0:
+            idx += size
+        if idx < 0 or idx >= size:
+            raise IndexError('array index out of range')
+        return idx
+    cdef inline int get_repeat_index(self, int x, int y):
+        return (x%self.width)+(y%self.height)*self.width
+    cpdef inline double get(self, int x, int y) except? -1:
+        return self.get_heights()[self.get_index(x, y)]
     cpdef inline double get_repeat(self, int x, int y):
         """This allows the algorithm to tile at the edges."""
-        return self.hmap[(x%self.width)+(y%self.height)*self.width]
+        return self.get_heights()[self.get_repeat_index(x, y)]
     cpdef inline set(self, int x, int y, double val):
-        self.hmap[x+y*self.height] = val
+        self.get_heights()[self.get_index(x, y)] = val
     cpdef inline set_repeat(self, int x, int y, double val):
         """This allows the algorithm to tile at the edges."""
-        self.hmap[(x%self.width)+(y%self.height)*self.width] = val
+        self.get_heights()[self.get_repeat_index(x, y)] = val
     cpdef inline add_repeat(self, int x, int y, double val):
-        self.hmap[(x%self.width)+(y%self.height)*self.width] += val
-    cpdef inline int get_col(self, int x, int y):
-        return self.cmap[x+y*self.height]
+        cdef float * hmap = self.get_heights()
+        cdef int idx = self.get_repeat_index(x, y)
+        hmap[idx] = hmap[idx] + val
+    cpdef inline int get_col(self, int x, int y) except? -1:
+        return self.get_colors()[self.get_index(x, y)]
     cpdef inline int get_col_repeat(self, int x, int y):
-        return self.cmap[(x%self.width)+(y%self.height)*self.width]
+        return self.get_colors()[self.get_repeat_index(x, y)]
     cpdef inline set_col_repeat(self, int x, int y, int val):
-        self.cmap[(x%self.width)+(y%self.height)*self.width] = val
+        self.get_colors()[self.get_repeat_index(x, y)] = val
     cpdef inline fill_col(self, int col):
-        for n in xrange(len(self.cmap)):
-            self.cmap[n] = col
+        cdef int * cmap = self.get_colors()
+        cdef int idx
+        for idx in range(self.get_size()):
+            cmap[idx] = col
     cpdef mult_repeat(self, int x, int y, double mult):
-        cdef int idx = (x%self.width)+(y%self.height)*self.width
-        self.hmap[idx] *= mult
+        cdef float * hmap = self.get_heights()
+        cdef int idx = self.get_repeat_index(x, y)
+        hmap[idx] = hmap[idx] * mult
     cpdef seed(self, double jitter, double midpoint):        
         cdef double halfjitter = jitter * 0.5
-        for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = midpoint + (random.random()*jitter -
-                                         halfjitter)
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        for idx in range(self.get_size()):
+            hmap[idx] = midpoint + (random.random()*jitter - halfjitter)
     cpdef peaking(self):
         """Adds a "peaking" feel to the map."""
-        for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx] * self.hmap[idx]
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        cdef double value
+        for idx in range(self.get_size()):
+            value = hmap[idx]
+            hmap[idx] = value * value
     cpdef dipping(self):
         """Adds a "dipping" feel to the map."""
-        for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = math.sin(self.hmap[idx]*(math.pi))
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        for idx in range(self.get_size()):
+            hmap[idx] = sin(<double>hmap[idx] * PI)
     cpdef rolling(self):
         """Adds a "rolling" feel to the map."""
-        for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = math.sin(self.hmap[idx]*(math.pi/2))
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        for idx in range(self.get_size()):
+            hmap[idx] = sin(<double>hmap[idx] * (PI / 2))
     cpdef smoothing(self):
         """Does some simple averaging to bring down the noise level."""
-        for x in xrange(0,self.width):
-            for y in xrange(0,self.height):
+        cdef float * hmap = self.get_heights()
+        cdef int x, y
+        cdef double top, left, right, bot, center
+        for x in range(self.width):
+            for y in range(self.height):
                 top = self.get_repeat(x,y-1)
                 left = self.get_repeat(x-1,y)
                 right = self.get_repeat(x+1,y)
                 bot = self.get_repeat(x,y+1)
-                center = self.hmap[x+y*self.width]
-                self.hmap[x+y*self.width] = (top + left + right + bot + center)/5
+                center = hmap[x+y*self.width]
+                hmap[x+y*self.width] = (top + left + right + bot + center)/5
     cpdef midpoint_displace(self, double jittervalue, \
                           double spanscalingmultiplier, \
                             int skip=0):
@@ -228,8 +274,9 @@ cdef class HeightMap:
         cdef float botleft
         cdef float botright
         cdef float center
+        cdef int iterations, x, y
         
-        for iterations in xrange(9): # hardcoded for 512x512
+        for iterations in range(9): # hardcoded for 512x512
             if skip>0:
                 skip-=1
                 span = span >> 1
@@ -237,15 +284,16 @@ cdef class HeightMap:
                 continue
             jitterrange = jittervalue * spanscaling
             jitteroffset = - jitterrange / 2
-            for x in xrange(0,self.width,span):
-                for y in xrange(0,self.height,span):
+            for x in range(0,self.width,span):
+                for y in range(0,self.height,span):
                     halfspan = span >> 1
                     topleft = self.get_repeat(x,y)
                     topright = self.get_repeat((x+span),y)
                     botleft = self.get_repeat(x,(y+span))
                     botright = self.get_repeat((x+span),(y+span))
                     center = (topleft+topright+botleft+botright) * 0.25\
-                             + (random.random() * jitterrange + jitteroffset)
+                             + (<double>random.random() * jitterrange +
+                                jitteroffset)
                     
                     self.set_repeat(x+halfspan,y,(topleft+topright+center)*0.33)
                     self.set_repeat(x,y+halfspan,(topleft+botleft+center)*0.33)
@@ -258,78 +306,104 @@ cdef class HeightMap:
             spanscaling = spanscaling * spanscalingmultiplier
     cpdef jitter_heights(self, double amount):
         """Image jittering filter. Amount is max pixels distance to jitter."""
+        cdef float * hmap = self.get_heights()
         cdef int nx = 0
         cdef int ny = 0
         cdef int idx = 0
 
-        while idx<len(self.hmap):
-            nx = int((idx % self.width) + (random.random()-0.5)*amount)
-            ny = int((idx // self.width) + (random.random()-0.5)*amount)
-            self.hmap[idx] = self.get_repeat(nx, ny)            
+        while idx<self.get_size():
+            nx = <int>((idx % self.width) +
+                       (<double>random.random()-0.5)*amount)
+            ny = <int>((idx // self.width) +
+                       (<double>random.random()-0.5)*amount)
+            hmap[idx] = self.get_repeat(nx, ny)            
             idx+=1
     cpdef jitter_colors(self, double amount):
         """Image jittering filter. Amount is max pixels distance to jitter."""
+        cdef int * cmap = self.get_colors()
         cdef int nx = 0
         cdef int ny = 0
         cdef int idx = 0
 
-        while idx<len(self.hmap):
-            nx = int((idx % self.width) + (random.random()-0.5)*amount)
-            ny = int((idx // self.width) + (random.random()-0.5)*amount)
-            self.cmap[idx] = self.get_col_repeat(nx, ny)            
+        while idx<self.get_size():
+            nx = <int>((idx % self.width) +
+                       (<double>random.random()-0.5)*amount)
+            ny = <int>((idx // self.width) +
+                       (<double>random.random()-0.5)*amount)
+            cmap[idx] = self.get_col_repeat(nx, ny)            
             idx+=1
         
     cpdef level_against_heightmap(self, HeightMap other, double height):
         """Use another HeightMap as an alpha-mask to force values to a
             specific height"""
-        for x in xrange(0, self.width):
-            for y in xrange(0, self.height):
+        cdef int x, y
+        cdef double orig, dist
+        for x in range(self.width):
+            for y in range(self.height):
                 orig = self.get_repeat(x,y)
                 dist = orig - height
                 self.set_repeat(x,y, orig - dist * other.get_repeat(x,y))
     cpdef blend_heightmaps(self, HeightMap alphamap, HeightMap HeightMap):
         """Blend according to two HeightMaps: one as an alpha-mask,
             the other contains desired heights"""
-        for x in xrange(0, self.width):
-            for y in xrange(0, self.height):
+        cdef int x, y
+        cdef double orig, dist
+        for x in range(self.width):
+            for y in range(self.height):
                 orig = self.get_repeat(x,y)
                 dist = orig - HeightMap.get_repeat(x,y)
                 self.set_repeat(x,y, orig - dist * alphamap.get_repeat(x,y))
     cpdef rect_solid(self, int x, int y, int w, int h, double z):
-        for xx in xrange(x, x+w):
-            for yy in xrange(y, y+h):
+        cdef int xx, yy
+        for xx in range(x, x+w):
+            for yy in range(y, y+h):
                 self.set_repeat(xx,yy,z)
     cpdef rect_noise(self, int x, int y, int w, int h,
                      double jitter, double midpoint):        
         cdef double halfjitter = jitter * 0.5
-        for xx in xrange(x,x+w):
-            for yy in xrange(y,y+h):            
-                self.set(xx,yy, midpoint + (random.random()*jitter -
-                                         halfjitter))
+        cdef int xx, yy
+        for xx in range(x,x+w):
+            for yy in range(y,y+h):            
+                self.set(xx,yy, midpoint + (<double>random.random()*jitter -
+                                            halfjitter))
     cpdef rect_color(self, int x, int y, int w, int h, int col):
-        for xx in xrange(x, x+w):
-            for yy in xrange(y, y+h):
+        cdef int xx, yy
+        for xx in range(x, x+w):
+            for yy in range(y, y+h):
                 self.set_col_repeat(xx,yy,col)        
     cpdef truncate(self):
         """Truncates the HeightMap to a valid (0-1) range.
         Do this before painting or writing to voxels to avoid crashing."""
-        for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = min(max(self.hmap[idx],0.0),1.0)
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        cdef double value
+        for idx in range(self.get_size()):
+            value = hmap[idx]
+            # the same as min(max(value, 0.0), 1.0)
+            if 0.0 > value:
+                value = 0.0
+            if 1.0 < value:
+                value = 1.0
+            hmap[idx] = value
     cpdef offset_z(self, double qty):
-        for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx]+qty
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        for idx in range(self.get_size()):
+            hmap[idx] = hmap[idx]+qty
     cpdef rescale_z(self, double multiple):
-        for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx]*multiple
+        cdef float * hmap = self.get_heights()
+        cdef int idx
+        for idx in range(self.get_size()):
+            hmap[idx] = hmap[idx]*multiple
     cpdef paint_gradient_fill(self, gradient):
         """Surface the map with a single gradient."""
         cdef zcoldef = gradient.array()        
-
+        cdef float * hmap = self.get_heights()
+        cdef int * cmap = self.get_colors()
         cdef int idx = 0
         
-        while idx<len(self.hmap):
-            h = int(self.hmap[idx] * 63)
-            self.cmap[idx] = paint_gradient(zcoldef,h)
+        while idx<self.get_size():
+            cmap[idx] = paint_gradient(zcoldef, <int>(hmap[idx] * 63.0))
             idx+=1
     cpdef rewrite_gradient_fill(self, list gradients):
         """Given a cmap of int-indexed gradient definitions,
@@ -339,37 +413,44 @@ cdef class HeightMap:
         for n in gradients:
             zcoldefs.append(n.array())
 
+        cdef float * hmap = self.get_heights()
+        cdef int * cmap = self.get_colors()
         cdef int idx = 0
         
-        while idx<len(self.hmap):
-            h = int(self.hmap[idx] * 63)
-            self.cmap[idx] = paint_gradient(zcoldefs[self.cmap[idx]],h)
+        while idx<self.get_size():
+            cmap[idx] = paint_gradient(zcoldefs[cmap[idx]],
+                                       <int>(hmap[idx] * 63.0))
             idx+=1
     cpdef rgb_noise_colors(self, low, high):
         """Add noise to the heightmap colors."""
+        cdef int * cmap = self.get_colors()
         cdef int idx = 0
+        cdef int mid, r, g, b
         
-        patterns = array.array('i', [random.randint(low,high) for n in xrange(101)])
+        cdef carray.array patterns = array.array('i',
+            [random.randint(low,high) for n in xrange(101)])
+        cdef int * pattern = patterns.data.as_ints
         
-        while idx<len(self.hmap):
-            mid = self.cmap[idx]
+        while idx<self.get_size():
+            mid = cmap[idx]
             
-            r = max(0, min(0xFF,get_r(mid)+patterns[idx%len(patterns)]))
-            g = max(0, min(0xFF,get_g(mid)+patterns[(idx+1)%len(patterns)]))
-            b = max(0, min(0xFF,get_b(mid)+patterns[(idx+2)%len(patterns)]))
+            r = int_max(0, int_min(0xFF, get_r(mid)+pattern[idx%101]))
+            g = int_max(0, int_min(0xFF, get_g(mid)+pattern[(idx+1)%101]))
+            b = int_max(0, int_min(0xFF, get_b(mid)+pattern[(idx+2)%101]))
             
-            self.cmap[idx] = make_color(r,g,b)
+            cmap[idx] = make_color(r,g,b)
             
             idx+=1
             
     cpdef smooth_colors(self):
         """Average the color of each pixel to add smoothness."""
+        cdef int * cmap = self.get_colors()
         cdef int x = 0
         cdef int y = 0
+        cdef int left, right, up, down, mid, r, g, b
         
-        import copy        
-        
-        swap = copy.deepcopy(self.cmap)
+        cdef carray.array swap_array = carray.copy(self.cmap)
+        cdef int * swap = swap_array.data.as_ints
         
         while y<self.height:
             left = swap[((x-1)%self.width)+(y%self.height)*self.width]
@@ -382,7 +463,7 @@ cdef class HeightMap:
             g = (get_g(left) + get_g(right) + get_g(up) + get_g(down) + get_g(mid))/5
             b = (get_b(left) + get_b(right) + get_b(up) + get_b(down) + get_b(mid))/5
             
-            self.set_col_repeat(x,y,make_color(r,g,b))
+            cmap[self.get_repeat_index(x, y)] = make_color(r,g,b)
             
             x += 1
             if x>=self.width:
@@ -390,21 +471,33 @@ cdef class HeightMap:
                 y += 1
         
     cpdef write_vxl(self):
+        """Returns a VXLData with a column for each height, solid from the
+        height down and colored for the top four voxels"""
         cdef VXLData vxl = VXLData()
+        cdef MapData * map = vxl.map
+        cdef float * hmap = self.get_heights()
+        cdef int * cmap = self.get_colors()
+
+        cdef int width = self.width
+        cdef int height = self.height
+        cdef int size = self.get_size()
 
         cdef int x = 0
         cdef int y = 0
         cdef int h = 0
-        cdef int z = 0
         cdef int idx = 0
 
-        while idx<len(self.hmap):
-            x = idx % self.width
-            y = idx // self.height
-            h = int(self.hmap[idx] * 63)
-            vxl.set_column_fast(x, y, h, 63, int(min(63,h+3)),
-                                self.cmap[idx])
-            idx+=1
+        with nogil:
+            while idx<size:
+                x = idx % width
+                y = idx // height
+                h = <int>(hmap[idx] * 63.0)
+                # heights outside 0-1 leave the column empty
+                if h >= 0 and h < 64 and is_valid_column(x, y):
+                    set_column_solid(x, y, h, 63, map, 1)
+                    set_column_color(x, y, h, int_min(63, h + 3), map,
+                                     cmap[idx])
+                idx+=1
         return vxl
     cpdef line_add(self,int x,int y,
                 int x2,int y2,int radius, double depth):
@@ -412,8 +505,8 @@ cdef class HeightMap:
         for c in bresenham_line(x,y,x2,y2):
             posx = c[0]
             posy = c[1]
-            for x in xrange(-radius,radius+1):
-                for y in xrange(-radius,radius+1):
+            for x in range(-radius,radius+1):
+                for y in range(-radius,radius+1):
                     self.add_repeat(posx+x,posy+y,depth)
     cpdef line_set(self,int x,int y,
                 int x2,int y2,int radius, double height):
@@ -421,10 +514,20 @@ cdef class HeightMap:
         for c in bresenham_line(x,y,x2,y2):
             posx = c[0]
             posy = c[1]
-            for x in xrange(-radius,radius+1):
-                for y in xrange(-radius,radius+1):
+            for x in range(-radius,radius+1):
+                for y in range(-radius,radius+1):
                     self.set_repeat(posx+x,posy+y,height)
 
+cdef inline int int_min(int a, int b) nogil:
+    if b < a:
+        return b
+    return a
+
+cdef inline int int_max(int a, int b) nogil:
+    if b > a:
+        return b
+    return a
+
 cdef lim_byte(int val):
     return max(0,min(255,val))
 
@@ -52,9 +52,10 @@ class BaseConnection(object):
             flags = enet.PACKET_FLAG_UNSEQUENCED
         else:
             flags = enet.PACKET_FLAG_RELIABLE
-        data = ByteWriter()
+        data = self.protocol.packet_writer
+        data.reset()
         contained.write(data)
-        packet = enet.Packet(str(data), flags)
+        packet = enet.Packet(data, flags)
         self.peer.send(0, packet)
     
     # events
@@ -88,6 +89,8 @@ class BaseProtocol(object):
         self.update_loop.start(update_interval, False)
         self.connections = {}
         self.clients = {}
+        # reused by send_contained() to write outgoing packets
+        self.packet_writer = ByteWriter()
     
     def connect(self, connection_class, host, port, version, channel_count = 1,
                 timeout = 5.0):
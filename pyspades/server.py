@@ -16,6 +16,7 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from twisted.internet.task import LoopingCall
 from pyspades.protocol import BaseConnection, BaseProtocol
 from pyspades.bytes import ByteReader, ByteWriter
@@ -37,8 +38,8 @@ import shlex
 import textwrap
 import collections
 import zlib
-
-COMPRESSION_LEVEL = 9
+from pyspades.compression import compress_map, COMPRESSION_LEVEL
+from pyspades.vxl import TILE_SIZE
 
 create_player = loaders.CreatePlayer()
 position_data = loaders.PositionData()
@@ -70,6 +71,8 @@ weapon_reload = loaders.WeaponReload()
 territory_capture = loaders.TerritoryCapture()
 progress_bar = loaders.ProgressBar()
 world_update = loaders.WorldUpdate()
+world_update.data = bytearray(32 * 24)
+EMPTY_WORLD_OBJECTS = (None,) * 32
 block_line = loaders.BlockLine()
 weapon_input = loaders.WeaponInput()
 
@@ -132,18 +135,47 @@ class MapGeneratorChild(object):
 class ProgressiveMapGenerator(object):
     data = ''
     done = False
+    compressing = False
     
     # parent attributes
     all_data = ''
     pos = 0
-    def __init__(self, map, parent = False):
+    def __init__(self, map, parent = False, workers = 1):
         self.parent = parent
-        self.generator = map.get_generator()
+        self.map = map
+        self.version = map.version
         self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        if parent and workers > 1:
+            # compress a snapshot of the whole map on several threads, off
+            # the reactor. children read nothing until it is done
+            self.generator = None
+            self.compressing = True
+            snapshot = map.copy()
+            deferToThread(compress_map, snapshot, workers).addCallbacks(
+                self._map_compressed, self._compress_failed,
+                errbackArgs = (snapshot,))
+        else:
+            self.generator = map.get_generator()
+    
+    def _map_compressed(self, data):
+        self.compressing = False
+        self.all_data = data
+        self.pos = len(data)
+    
+    def _compress_failed(self, failure, snapshot):
+        print 'Could not compress map in parallel: %s' % (
+            failure.getErrorMessage())
+        self.compressing = False
+        self.generator = snapshot.get_generator()
     
     def get_size(self):
+        if self.parent and self.generator is None and not self.compressing:
+            return len(self.all_data)
         return 1.5 * 1024 * 1024 # 2 mb
     
+    def is_current(self, map):
+        return map is self.map and map.version == self.version
+    
     def read(self, size):
         data = self.data
         generator = self.generator
@@ -169,7 +201,8 @@ class ProgressiveMapGenerator(object):
         return MapGeneratorChild(self)
     
     def data_left(self):
-        return bool(self.data) or self.generator is not None
+        return (bool(self.data) or self.generator is not None or
+            self.compressing)
 
 class ServerConnection(BaseConnection):
     address = None
@@ -531,12 +564,10 @@ class ServerConnection(BaseConnection):
                                 self.blocks = min(50, self.blocks + 1)
                                 self.on_block_removed(x, y, z)
                         elif value == SPADE_DESTROY:
-                            if map.destroy_point(x, y, z):
-                                self.on_block_removed(x, y, z)
-                            if map.destroy_point(x, y, z + 1):
-                                self.on_block_removed(x, y, z + 1)
-                            if map.destroy_point(x, y, z - 1):
-                                self.on_block_removed(x, y, z - 1)
+                            removed, collapsed = map.destroy_points(
+                                [(x, y, z), (x, y, z + 1), (x, y, z - 1)])
+                            for point in removed:
+                                self.on_block_removed(*point)
                         self.last_block_destroy = reactor.seconds()
                     block_action.x = x
                     block_action.y = y
@@ -922,7 +953,7 @@ class ServerConnection(BaseConnection):
     
     def _connection_ack(self):
         self._send_connection_data()
-        self.send_map(ProgressiveMapGenerator(self.protocol.map))
+        self.send_map(self.protocol.get_map_data())
     
     def _send_connection_data(self):
         saved_loaders = self.saved_loaders = []
@@ -1031,11 +1062,10 @@ class ServerConnection(BaseConnection):
         if self.on_block_destroy(x, y, z, GRENADE_DESTROY) == False:
             return
         map = self.protocol.map
-        for nade_x in xrange(x - 1, x + 2):
-            for nade_y in xrange(y - 1, y + 2):
-                for nade_z in xrange(z - 1, z + 2):
-                    if map.destroy_point(nade_x, nade_y, nade_z):
-                        self.on_block_removed(nade_x, nade_y, nade_z)
+        removed, collapsed = map.destroy_box(x - 1, y - 1, z - 1,
+            x + 1, y + 1, z + 1)
+        for point in removed:
+            self.on_block_removed(*point)
         block_action.x = x
         block_action.y = y
         block_action.z = z
@@ -1079,7 +1109,11 @@ class ServerConnection(BaseConnection):
         for _ in xrange(10):
             if not self.map_data.data_left():
                 break
-            map_data.data = self.map_data.read(1024)
+            data = self.map_data.read(1024)
+            if not data:
+                # the map is still being compressed, so try again next time
+                break
+            map_data.data = data
             self.send_contained(map_data)
     
     def continue_map_transfer(self):
@@ -1219,6 +1253,7 @@ class ServerConnection(BaseConnection):
 
 class Entity(Vertex3):
     team = None
+    map_state = None
     def __init__(self, id, protocol, *arg, **kw):
         Vertex3.__init__(self, *arg, **kw)
         self.id = id
@@ -1450,6 +1485,8 @@ class ServerProtocol(BaseProtocol):
     master = False
     max_score = 10
     map = None
+    map_data = None
+    map_workers = 1
     spade_teamkills_on_grief = False
     friendly_fire = False
     friendly_fire_time = 2
@@ -1496,6 +1533,7 @@ class ServerProtocol(BaseProtocol):
         self.blue_team.other = self.green_team
         self.green_team.other = self.blue_team
         self.world = world.World()
+        self.world_update_objects = [None] * 32
         self.set_master()
         
         # safe position LUT
@@ -1514,10 +1552,13 @@ class ServerProtocol(BaseProtocol):
             flags = enet.PACKET_FLAG_UNSEQUENCED
         else:
             flags = enet.PACKET_FLAG_RELIABLE
-        data = ByteWriter()
-        contained.write(data)
-        data = str(data)
-        packet = enet.Packet(data, flags)
+        writer = self.packet_writer
+        writer.reset()
+        contained.write(writer)
+        # created before the rules run, since they may send packets too
+        packet = enet.Packet(writer, flags)
+        data = None
+        peers = []
         for player in self.connections.values():
             if player is sender or player.player_id is None:
                 continue
@@ -1527,9 +1568,13 @@ class ServerProtocol(BaseProtocol):
                 continue
             if player.saved_loaders is not None:
                 if save:
+                    if data is None:
+                        data = packet.data
                     player.saved_loaders.append(data)
             else:
-                player.peer.send(0, packet)
+                peers.append(player.peer)
+        if peers:
+            self.host.multicast(0, packet, peers)
     
     def reset_tc(self):
         self.entities = self.get_cp_entities()
@@ -1581,25 +1626,28 @@ class ServerProtocol(BaseProtocol):
             self.update_network()
     
     def update_network(self):
-        items = []
-        for i in xrange(32):
-            position = orientation = None
-            try:
-                player = self.players[i]
-                if (not player.filter_visibility_data and 
-                not player.team.spectator):
-                    world_object = player.world_object
-                    position = world_object.position.get()
-                    orientation = world_object.orientation.get()
-            except (KeyError, TypeError, AttributeError):
-                pass
-            if position is None:
-                position = (0.0, 0.0, 0.0)
-                orientation = (0.0, 0.0, 0.0)
-            items.append((position, orientation))
-        world_update.items = items
+        world_objects = self.world_update_objects
+        world_objects[:] = EMPTY_WORLD_OBJECTS
+        for player in self.players.itervalues():
+            team = player.team
+            if (player.filter_visibility_data or team is None or
+            team.spectator or player.player_id >= 32):
+                continue
+            world_objects[player.player_id] = player.world_object
+        world.write_world_update(world_objects, world_update.data)
         self.send_contained(world_update, unsequenced = True)
     
+    def get_map_data(self):
+        """Returns a reader for the compressed map stream. The stream is
+        shared by all players joining while the map is unchanged, so it is
+        only encoded and compressed once."""
+        map_data = self.map_data
+        if map_data is None or not map_data.is_current(self.map):
+            map_data = ProgressiveMapGenerator(self.map, parent = True,
+                workers = self.map_workers)
+            self.map_data = map_data
+        return map_data.get_child()
+    
     def set_map(self, map):
         self.map = map
         self.world.map = map
@@ -1610,7 +1658,6 @@ class ServerProtocol(BaseProtocol):
             self.reset_tc()
         self.players = MultikeyDict()
         if self.connections:
-            data = ProgressiveMapGenerator(self.map, parent = True)
             for connection in self.connections.values():
                 if connection.player_id is None:
                     continue
@@ -1619,7 +1666,7 @@ class ServerProtocol(BaseProtocol):
                     continue
                 connection.reset()
                 connection._send_connection_data()
-                connection.send_map(data.get_child())
+                connection.send_map(self.get_map_data())
         self.update_entities()
     
     def reset_game(self, player = None, territory = None):
@@ -1697,9 +1744,23 @@ class ServerProtocol(BaseProtocol):
                 count += 1
         self.master_connection.set_count(count)
     
+    def get_entity_state(self, entity):
+        map = self.map
+        x = int(entity.x)
+        y = int(entity.y)
+        if not (0 <= x < 512 and 0 <= y < 512):
+            return None
+        return (map, entity.x, entity.y, entity.z,
+            map.get_tile_version(x // TILE_SIZE, y // TILE_SIZE))
+    
     def update_entities(self):
         map = self.map
         for entity in self.entities:
+            # entities only have to be looked at again if they moved or the
+            # map around them changed
+            state = self.get_entity_state(entity)
+            if state is not None and state == entity.map_state:
+                continue
             moved = False
             if map.get_solid(entity.x, entity.y, entity.z - 1):
                 moved = True
@@ -1712,6 +1773,7 @@ class ServerProtocol(BaseProtocol):
                     entity.z += 1
             if moved or self.on_update_entity(entity):
                 entity.update()
+            entity.map_state = self.get_entity_state(entity)
     
     def send_chat(self, value, global_message = None, sender = None,
                   team = None):
@@ -1,35 +1,76 @@
+from libcpp.vector cimport vector
+from libc.stdint cimport uint64_t
+
 cdef extern from "vxl_c.cpp":
     enum:
         MAP_X
         MAP_Y
         MAP_Z
         DEFAULT_COLOR
+        SECTOR_SIZE
+        SECTORS_X
+        SECTORS_Y
+        SECTOR_COUNT
     struct MapData:
-        pass
+        unsigned int version
     struct MapGenerator:
         pass
+    struct Position:
+        int x, y, z
+    struct MapChange:
+        int color
+        unsigned short x, y
+        unsigned char z, type
     MapGenerator * create_map_generator(MapData * original)
     void delete_map_generator(MapGenerator * generator)
-    object get_generator_data(MapGenerator * generator, int columns)
-    MapData * load_vxl(unsigned char * v)
+    void get_generator_data(MapGenerator * generator, int columns,
+        vector[char] * data) nogil
+    MapData * load_vxl(unsigned char * v) nogil
     MapData * copy_map(MapData * map)
-    void delete_vxl(MapData * map)
-    object save_vxl(MapData * map)
-    int check_node(int x, int y, int z, MapData * map, int destroy)
+    size_t get_memory_size(MapData * map)
+    uint64_t get_changed_sectors(MapData * map, MapData * other)
+    void start_change_log(MapData * map)
+    void stop_change_log(MapData * map)
+    void replace_map(MapData * map, MapData * old)
+    unsigned int get_sector_version(MapData * map, int x, int y)
+    bint flush_change_log(MapData * map, vector[Position] * changed)
+    void get_map_diff(MapData * map, MapData * other, int x1, int y1,
+        int x2, int y2, vector[MapChange] * changes) nogil
+    int apply_map_diff(MapData * map, MapChange * changes, size_t count)
+    void get_region(MapData * map, int x1, int y1, int z1, int x2, int y2,
+        int z2, char * solid, int * colors) nogil
+    void set_region(MapData * map, int x1, int y1, int z1, int x2, int y2,
+        int z2, char * solid, int * colors) nogil
+    void delete_vxl(MapData * map) nogil
+    void save_vxl(MapData * map, vector[char] * data, int y1, int y2) nogil
+    void save_snapshot(MapData * map, vector[char] * data) nogil
+    MapData * load_snapshot(char * data, size_t size) nogil
+    int check_node(int x, int y, int z, MapData * map, int destroy) nogil
+    void destroy_nodes(MapData * map, Position * points, int count,
+        vector[Position] * removed, vector[Position] * collapsed) nogil
     bint get_solid(int x, int y, int z, MapData * map)
     int get_color(int x, int y, int z, MapData * map)
     void set_point(int x, int y, int z, MapData * map, bint solid, int color)
     void set_column_solid(int x, int y, int start_z, int end_z,
-        MapData * map, bint solid)
+        MapData * map, bint solid) nogil
     void set_column_color(int x, int y, int start_z, int end_z,
-        MapData * map, int color)
+        MapData * map, int color) nogil
     int get_random_point(int x1, int y1, int x2, int y2, MapData * map, 
         float random_1, float random_2, int * x, int * y)
+    int count_land(int x1, int y1, int x2, int y2, MapData * map)
     bint is_valid_position(int x, int y, int z)
-    void update_shadows(MapData * map)
+    bint is_valid_column(int x, int y) nogil
+    int get_top(int x, int y, int start, MapData * map)
+    int get_bottom_height(int x, int y, MapData * map)
+    void update_shadows(MapData * map) nogil
+    void get_overview(MapData * map, int z, bint rgba, int x1, int y1,
+        int x2, int y2, unsigned int * data) nogil
+    void get_layers(MapData * map, bint rgba, unsigned int * data) nogil
+    void set_layer(MapData * map, int z, unsigned int * data) nogil
 
 cdef class VXLData:
     cdef MapData * map
+    cdef list observers
     
     cpdef get_solid(self, int x, int y, int z)
     cpdef get_color(self, int x, int y, int z)
@@ -40,7 +81,10 @@ cdef class VXLData:
     cpdef bint is_surface(self, int x, int y, int z)
     cpdef list get_neighbors(self, int x, int y, int z)
     cpdef bint check_node(self, int x, int y, int z, bint destroy = ?)
+    cdef tuple destroy_positions(self, vector[Position] * points)
     cpdef bint build_point(self, int x, int y, int z, tuple color)
     cpdef bint set_column_fast(self, int x, int y, int start_z,
         int end_z, int end_color_z, int color)
-    cpdef update_shadows(self)
\ No newline at end of file
+    cpdef update_shadows(self)
+    cdef notify(self)
+    cdef set_map(self, MapData * map)
\ No newline at end of file
@@ -15,6 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
+from libc.string cimport memcpy
+
+cdef extern from *:
+    ctypedef void * const_void_ptr "const void *"
+
+cdef extern from "Python.h":
+    int PyObject_AsReadBuffer(object obj, const_void_ptr * buffer,
+        Py_ssize_t * buffer_len) except -1
+    object PyByteArray_FromStringAndSize(char * string, Py_ssize_t size)
+    char * PyByteArray_AS_STRING(object bytearray)
 from pyspades.common cimport allocate_memory
 
 cdef tuple make_color_tuple(int color):
@@ -28,9 +38,41 @@ cdef tuple make_color_tuple(int color):
 cpdef inline int make_color(int r, int g, int b, int a = 255):
     return b | (g << 8) | (r << 16) | (<int>((a / 255.0) * 128) << 24)
 
+cdef object make_string(vector[char] * data):
+    cdef char * out
+    value = allocate_memory(data.size(), &out)
+    if not data.empty():
+        memcpy(out, &data.front(), data.size())
+    return value
+
 import time
 import random
 
+TILE_SIZE = SECTOR_SIZE
+
+def unpack_diff(data):
+    """Returns the changes from VXLData.diff() as a list of
+        (x, y, z, type, color) tuples, with type one of the DIFF_* constants
+        in pyspades.constants and color an (r, g, b) tuple."""
+    cdef const_void_ptr c_data
+    cdef Py_ssize_t size
+    cdef MapChange * changes
+    cdef unsigned int i
+    cdef list values = []
+    PyObject_AsReadBuffer(data, &c_data, &size)
+    changes = <MapChange*>c_data
+    for i in range(size / sizeof(MapChange)):
+        values.append((changes[i].x, changes[i].y, changes[i].z,
+            changes[i].type, make_color_tuple(changes[i].color)))
+    return values
+
+cdef int get_region_size(int x1, int y1, int z1, int x2, int y2,
+                         int z2) except -1:
+    if (x1 < 0 or y1 < 0 or z1 < 0 or x2 > MAP_X or y2 > MAP_Y or
+        z2 > MAP_Z or x1 > x2 or y1 > y2 or z1 > z2):
+        raise ValueError('invalid region')
+    return (x2 - x1) * (y2 - y1) * (z2 - z1)
+
 cdef class Generator:
     cdef MapGenerator * generator
     cdef public:
@@ -41,13 +83,15 @@ cdef class Generator:
         self.generator = create_map_generator(data.map)
     
     def get_data(self, int columns = 2):
+        cdef vector[char] data
         if self.done:
             return None
-        value = get_generator_data(self.generator, columns)
-        if not value:
+        with nogil:
+            get_generator_data(self.generator, columns, &data)
+        if data.empty():
             self.done = True
             return None
-        return value
+        return make_string(&data)
     
     def __dealloc__(self):
         delete_map_generator(self.generator)
@@ -55,21 +99,92 @@ cdef class Generator:
 cdef class VXLData:
     def __init__(self, fp = None):
         cdef unsigned char * c_data
+        self.observers = []
         if fp is not None:
             data = fp.read()
             c_data = data
         else:
             c_data = NULL
-        self.map = load_vxl(c_data)
+        with nogil:
+            self.map = load_vxl(c_data)
+    
+    def load_vxl(self, data = None):
+        cdef MapData * new_map
+        cdef unsigned char * c_data
+        if data is not None:
+            c_data = data
+        else:
+            c_data = NULL
+        with nogil:
+            new_map = load_vxl(c_data)
+        self.set_map(new_map)
+    
+    property version:
+        """Goes up whenever the map is changed."""
+        def __get__(self):
+            return self.map.version
+    
+    def get_tile_version(self, int x, int y):
+        """Returns a number that goes up whenever tile (x, y) of the map is
+            changed. Tiles are TILE_SIZE x TILE_SIZE columns."""
+        if x < 0 or x >= SECTORS_X or y < 0 or y >= SECTORS_Y:
+            raise IndexError('invalid tile')
+        return get_sector_version(self.map, x, y)
+    
+    def add_observer(self, callback):
+        """Calls callback(map, changes) after each change to the map, with
+            the list of (x, y, z) voxels that were built, removed or
+            recolored, or None if the whole map was replaced or too much of
+            it changed to list (see MAX_LOGGED_COLUMNS in vxl_c.h)."""
+        if not self.observers:
+            start_change_log(self.map)
+        self.observers.append(callback)
+    
+    def remove_observer(self, callback):
+        self.observers.remove(callback)
+        if not self.observers:
+            stop_change_log(self.map)
+    
+    cdef notify(self):
+        cdef vector[Position] changed
+        cdef Position * position
+        cdef unsigned int i
+        if not self.observers:
+            return
+        if flush_change_log(self.map, &changed):
+            changes = None
+        elif changed.empty():
+            return
+        else:
+            changes = []
+            for i in range(changed.size()):
+                position = &changed[i]
+                changes.append((position.x, position.y, position.z))
+        for callback in self.observers[:]:
+            callback(self, changes)
     
-    def load_vxl(self, c_data = None):
-        self.map = load_vxl(c_data)
+    cdef set_map(self, MapData * map):
+        cdef MapData * old_map = self.map
+        replace_map(map, old_map)
+        self.map = map
+        delete_vxl(old_map)
+        if self.observers:
+            for callback in self.observers[:]:
+                callback(self, None)
     
     def copy(self):
+        """Returns a copy of the map. The copy shares its data with this map
+            until either of them is changed, so it is cheap to take."""
         cdef VXLData map = VXLData()
+        delete_vxl(map.map)
         map.map = copy_map(self.map)
         return map
     
+    def get_memory_size(self):
+        """Returns roughly how many bytes of memory the map holds, counting
+            data shared with copies in full."""
+        return get_memory_size(self.map)
+    
     def get_point(self, int x, int y, int z):
         color = self.get_color(x, y, z)
         solid = color is not None
@@ -78,6 +193,7 @@ cdef class VXLData:
     def set_point(self, int x, int y, int z, tuple color):
         if is_valid_position(x, y, z):
             set_point(x, y, z, self.map, 1, make_color(*color))
+            self.notify()
 
     cpdef get_solid(self, int x, int y, int z):
         if not is_valid_position(x, y, z):
@@ -90,17 +206,10 @@ cdef class VXLData:
         return make_color_tuple(get_color(x, y, z, self.map))
     
     cpdef int get_z(self, int x, int y, int start = 0):
-        for z in xrange(start, 64):
-            if get_solid(x, y, z, self.map):
-                return z
-        return 0
+        return get_top(x, y, start, self.map)
     
     cpdef int get_height(self, int x, int y):
-        cdef int start = 63
-        for z in xrange(start, -1, -1):
-            if not get_solid(x, y, z, self.map):
-                return z + 1
-        return 0
+        return get_bottom_height(x, y, self.map)
     
     cpdef tuple get_random_point(self, int x1, int y1, int x2, int y2):
         cdef int x, y
@@ -108,66 +217,113 @@ cdef class VXLData:
             random.random(), &x, &y)
         return x, y
     
-    def count_land(self, int x1, y1, x2, y2):
-        cdef int land = 0
-        for x in xrange(x1, x2):
-            for y in xrange(y1, y2):
-                if self.get_solid(x, y, 62):
-                    land += 1
-        return land
+    def count_land(self, int x1, int y1, int x2, int y2):
+        return count_land(x1, y1, x2, y2, self.map)
     
     def destroy_point(self, int x, int y, int z):
         if not self.get_solid(x, y, z) or z >= 62:
             return False
-        set_point(x, y, z, self.map, 0, 0)
         start = time.time()
-        for node_x, node_y, node_z in self.get_neighbors(x, y, z):
-            if node_z < 62:
-                self.check_node(node_x, node_y, node_z, True)
+        self.destroy_points([(x, y, z)])
         taken = time.time() - start
         if taken > 0.1:
             print 'destroying block at', x, y, z, 'took:', taken
         return True
     
+    def destroy_points(self, points):
+        """Destroy a sequence of (x, y, z) points and everything that is
+            left floating, with one connectivity pass for all of them.
+            Returns (removed, collapsed), the lists of points that were
+            removed directly and of the ones that fell down."""
+        cdef vector[Position] positions
+        cdef Position position
+        for position.x, position.y, position.z in points:
+            positions.push_back(position)
+        return self.destroy_positions(&positions)
+    
+    def destroy_box(self, int x1, int y1, int z1, int x2, int y2, int z2):
+        """Like destroy_points, for all points from (x1, y1, z1) up to and
+            including (x2, y2, z2)."""
+        cdef vector[Position] positions
+        cdef Position position
+        for position.x in range(x1, x2 + 1):
+            for position.y in range(y1, y2 + 1):
+                for position.z in range(z1, z2 + 1):
+                    positions.push_back(position)
+        return self.destroy_positions(&positions)
+    
+    cdef tuple destroy_positions(self, vector[Position] * points):
+        cdef vector[Position] removed, collapsed
+        cdef list removed_list = [], collapsed_list = []
+        cdef Position * position
+        cdef unsigned int i
+        if points.empty():
+            return removed_list, collapsed_list
+        with nogil:
+            destroy_nodes(self.map, &points.front(), points.size(), &removed,
+                &collapsed)
+        if removed.empty():
+            return removed_list, collapsed_list
+        self.notify()
+        for i in range(removed.size()):
+            position = &removed[i]
+            removed_list.append((position.x, position.y, position.z))
+        for i in range(collapsed.size()):
+            position = &collapsed[i]
+            collapsed_list.append((position.x, position.y, position.z))
+        return removed_list, collapsed_list
+    
     def remove_point(self, int x, int y, int z):
         if is_valid_position(x, y, z):
             set_point(x, y, z, self.map, 0, 0)
+            self.notify()
     
     cpdef bint has_neighbors(self, int x, int y, int z):
+        cdef MapData * map = self.map
         return (
-            self.get_solid(x + 1, y, z) or
-            self.get_solid(x - 1, y, z) or
-            self.get_solid(x, y + 1, z) or
-            self.get_solid(x, y - 1, z) or
-            self.get_solid(x, y, z + 1) or
-            self.get_solid(x, y, z - 1)
+            get_solid(x + 1, y, z, map) or
+            get_solid(x - 1, y, z, map) or
+            get_solid(x, y + 1, z, map) or
+            get_solid(x, y - 1, z, map) or
+            get_solid(x, y, z + 1, map) or
+            get_solid(x, y, z - 1, map)
         )
     
     cpdef bint is_surface(self, int x, int y, int z):
+        cdef MapData * map = self.map
         return (
-            not self.get_solid(x, y, z - 1) or
-            not self.get_solid(x, y, z + 1) or
-            not self.get_solid(x + 1, y, z) or
-            not self.get_solid(x - 1, y, z) or
-            not self.get_solid(x, y + 1, z) or
-            not self.get_solid(x, y - 1, z)
+            not get_solid(x, y, z - 1, map) or
+            not get_solid(x, y, z + 1, map) or
+            not get_solid(x + 1, y, z, map) or
+            not get_solid(x - 1, y, z, map) or
+            not get_solid(x, y + 1, z, map) or
+            not get_solid(x, y - 1, z, map)
         )
     
     cpdef list get_neighbors(self, int x, int y, int z):
         cdef list neighbors = []
-        for (node_x, node_y, node_z) in (
-            (x, y, z - 1),
-            (x, y - 1, z),
-            (x, y + 1, z),
-            (x - 1, y, z),
-            (x + 1, y, z),
-            (x, y, z + 1)):
-            if self.get_solid(node_x, node_y, node_z):
-                neighbors.append((node_x, node_y, node_z))
+        cdef MapData * map = self.map
+        if get_solid(x, y, z - 1, map):
+            neighbors.append((x, y, z - 1))
+        if get_solid(x, y - 1, z, map):
+            neighbors.append((x, y - 1, z))
+        if get_solid(x, y + 1, z, map):
+            neighbors.append((x, y + 1, z))
+        if get_solid(x - 1, y, z, map):
+            neighbors.append((x - 1, y, z))
+        if get_solid(x + 1, y, z, map):
+            neighbors.append((x + 1, y, z))
+        if get_solid(x, y, z + 1, map):
+            neighbors.append((x, y, z + 1))
         return neighbors
     
     cpdef bint check_node(self, int x, int y, int z, bint destroy = False):
-        return check_node(x, y, z, self.map, destroy)
+        cdef bint ret
+        with nogil:
+            ret = check_node(x, y, z, self.map, destroy)
+        if destroy and not ret:
+            self.notify()
+        return ret
     
     cpdef bint build_point(self, int x, int y, int z, tuple color):
         if not is_valid_position(x, y, z):
@@ -176,6 +332,7 @@ cdef class VXLData:
             return False
         r, g, b = color
         set_point(x, y, z, self.map, 1, make_color(*color))
+        self.notify()
         return True
     
     cpdef bint set_column_fast(self, int x, int y, int z_start,
@@ -189,65 +346,175 @@ cdef class VXLData:
         set_column_solid(x, y, z_start, z_end, self.map, 1)
         
         if not is_valid_position(x, y, z_color_end) or z_color_end < z_start:
+            self.notify()
             return False
         set_column_color(x, y, z_start, z_color_end, self.map, color)
+        self.notify()
         return True
     
     cpdef update_shadows(self):
-        update_shadows(self.map)
+        with nogil:
+            update_shadows(self.map)
+        self.notify()
+    
+    def get_region(self, int x1, int y1, int z1, int x2, int y2, int z2):
+        """Returns the voxels from (x1, y1, z1) up to but not including
+            (x2, y2, z2) as two bytearrays: one byte per voxel that is 1 if
+            it is solid, and one color int per voxel, 0 if it has none.
+            Voxels are ordered by x, then y, then z, so NumPy can view them
+            without copying as arrays of shape (x2 - x1, y2 - y1, z2 - z1)."""
+        cdef int size = get_region_size(x1, y1, z1, x2, y2, z2)
+        solid = PyByteArray_FromStringAndSize(NULL, size)
+        colors = PyByteArray_FromStringAndSize(NULL, size * sizeof(int))
+        cdef char * c_solid = PyByteArray_AS_STRING(solid)
+        cdef int * c_colors = <int*>PyByteArray_AS_STRING(colors)
+        with nogil:
+            get_region(self.map, x1, y1, z1, x2, y2, z2, c_solid, c_colors)
+        return solid, colors
     
-    def get_overview(self, int z = -1, bint rgba = False):
+    def set_region(self, int x1, int y1, int z1, int x2, int y2, int z2,
+                   solid, colors = None):
+        """Replaces the voxels of a region with buffers laid out like those
+            from get_region(). Voxels are solid where solid is not 0. If
+            colors is None, solid voxels keep their colors and new ones get
+            the default color."""
+        cdef int size = get_region_size(x1, y1, z1, x2, y2, z2)
+        cdef const_void_ptr c_solid
+        cdef const_void_ptr c_colors = NULL
+        cdef Py_ssize_t solid_size, colors_size
+        PyObject_AsReadBuffer(solid, &c_solid, &solid_size)
+        if solid_size != size:
+            raise ValueError('solid buffer does not match the region')
+        if colors is not None:
+            PyObject_AsReadBuffer(colors, &c_colors, &colors_size)
+            if colors_size != size * sizeof(int):
+                raise ValueError('colors buffer does not match the region')
+        with nogil:
+            set_region(self.map, x1, y1, z1, x2, y2, z2, <char*>c_solid,
+                <int*>c_colors)
+        self.notify()
+    
+    def get_overview(self, int z = -1, bint rgba = False, int x1 = 0,
+                     int y1 = 0, int x2 = MAP_X, int y2 = MAP_Y):
+        """Returns an image of the map as 32-bit pixels, y major. With
+            z = -1, each pixel has the color of the top of its column,
+            otherwise that of layer z, transparent where it is not solid.
+            If x1, y1, x2 and y2 are given, only the columns from (x1, y1)
+            up to but not including (x2, y2) are included."""
         cdef unsigned int * data
-        cdef unsigned int i, r, g, b, a, color
-        data_python = allocate_memory(sizeof(int[512][512]), <char**>&data)
-        i = 0
-        cdef int current_z
-        if z == -1:
-            a = 255
+        get_region_size(x1, y1, 0, x2, y2, 1)
+        data_python = allocate_memory((x2 - x1) * (y2 - y1) * sizeof(int),
+            <char**>&data)
+        with nogil:
+            get_overview(self.map, z, rgba, x1, y1, x2, y2, data)
+        return data_python
+    
+    def get_changed_tiles(self, VXLData other = None):
+        """Returns the (x, y) indexes of the TILE_SIZE x TILE_SIZE tiles of
+            columns that may have changed since other was copied from this
+            map, or from which this map was copied. All tiles are returned
+            if other is None or not related to this map."""
+        cdef uint64_t changed
+        cdef int i
+        if other is None:
+            changed = <uint64_t>-1
         else:
-            current_z = z
-        for y in xrange(512):
-            for x in xrange(512):
-                if z == -1:
-                    current_z = self.get_z(x, y)
-                else:
-                    if get_solid(x, y, z, self.map):
-                        a = 255
-                    else:
-                        a = 0
-                color = get_color(x, y, current_z, self.map)
-                if rgba:
-                    b = color & 0xFF
-                    g = (color & 0xFF00) >> 8
-                    r = (color & 0xFF0000) >> 16
-                    data[i] = r | (g << 8) | (b << 16) | (a << 24)
-                else:
-                    data[i] = (color & 0x00FFFFFF) | (a << 24)
-                i += 1
+            changed = get_changed_sectors(self.map, other.map)
+        tiles = []
+        for i in range(SECTOR_COUNT):
+            if (changed >> i) & 1:
+                tiles.append((i % SECTORS_X, i / SECTORS_X))
+        return tiles
+    
+    def get_layers(self, bint rgba = False):
+        """Returns all 64 layers as get_overview(z) would, one after the
+            other in a single string."""
+        cdef unsigned int * data
+        data_python = allocate_memory(sizeof(int[MAP_Z][512][512]),
+            <char**>&data)
+        with nogil:
+            get_layers(self.map, rgba, data)
         return data_python
     
     def set_overview(self, data_str, int z):
-        cdef unsigned int * data
-        cdef unsigned int r, g, b, a, color, i, new_color
-        data = <unsigned int*>(<char*>data_str)
-        i = 0
-        for y in xrange(512):
-            for x in xrange(512):
-                color = data[i]
-                a = (color & <unsigned int>0xFF000000) >> 24
-                if a != 255:
-                    set_point(x, y, z, self.map, 0, 0)
-                else:
-                    set_point(x, y, z, self.map, 1, color)
-                i += 1
-    
-    def generate(self):
+        """Sets layer z from an image like get_overview(z) returns."""
+        cdef const_void_ptr data
+        cdef Py_ssize_t size
+        if z < 0 or z >= MAP_Z:
+            raise ValueError('invalid layer')
+        PyObject_AsReadBuffer(data_str, &data, &size)
+        if size != sizeof(int[512][512]):
+            raise ValueError('invalid overview size')
+        with nogil:
+            set_layer(self.map, z, <unsigned int*>data)
+        self.notify()
+    
+    def generate(self, int y1 = 0, int y2 = MAP_Y):
+        """Returns the map in VXL format. If y1 and y2 are given, only the
+            rows from y1 up to but not including y2 are encoded."""
+        cdef vector[char] data
+        y1 = max(0, y1)
+        y2 = min(MAP_Y, y2)
         start = time.time()
-        data = save_vxl(self.map)
+        with nogil:
+            save_vxl(self.map, &data, y1, y2)
+        value = make_string(&data)
         dt = time.time() - start
         if dt > 1.0:
             print 'VXLData.generate() took %s' % (dt)
-        return data
+        return value
+    
+    def get_snapshot(self):
+        """Returns the map in the snapshot format, which loads much faster
+            than VXL data. Snapshots are only meant to be read back by the
+            same build of pyspades."""
+        cdef vector[char] data
+        with nogil:
+            save_snapshot(self.map, &data)
+        return make_string(&data)
+    
+    def load_snapshot(self, data):
+        """Replaces the map with a snapshot from get_snapshot(). data can be
+            any object with a read buffer, like an mmap. Raises ValueError
+            if it is not a valid snapshot."""
+        cdef const_void_ptr c_data
+        cdef Py_ssize_t size
+        cdef MapData * new_map
+        PyObject_AsReadBuffer(data, &c_data, &size)
+        with nogil:
+            new_map = load_snapshot(<char*>c_data, size)
+        if new_map == NULL:
+            raise ValueError('invalid map snapshot')
+        self.set_map(new_map)
+    
+    def diff(self, VXLData other, int x1 = 0, int y1 = 0, int x2 = MAP_X,
+             int y2 = MAP_Y):
+        """Returns the changes that turn the region (x1, y1) - (x2, y2) of
+            this map into that of other, packed for apply_diff(). Use
+            unpack_diff() to read them."""
+        cdef vector[MapChange] changes
+        cdef char * out
+        with nogil:
+            get_map_diff(self.map, other.map, x1, y1, x2, y2, &changes)
+        value = allocate_memory(changes.size() * sizeof(MapChange), &out)
+        if not changes.empty():
+            memcpy(out, &changes.front(), changes.size() * sizeof(MapChange))
+        return value
+    
+    def apply_diff(self, data):
+        """Makes the changes returned by diff(). Raises ValueError if they
+            are not valid."""
+        cdef const_void_ptr c_data
+        cdef Py_ssize_t size
+        cdef int ret
+        PyObject_AsReadBuffer(data, &c_data, &size)
+        if size % sizeof(MapChange) != 0:
+            raise ValueError('invalid map diff')
+        ret = apply_map_diff(self.map, <MapChange*>c_data,
+            size / sizeof(MapChange))
+        self.notify()
+        if not ret:
+            raise ValueError('invalid map diff')
     
     def get_generator(self):
         return Generator(self)
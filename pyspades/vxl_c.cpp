@@ -20,6 +20,7 @@
 
 #include "Python.h"
 #include "vxl_c.h"
+#include <string.h>
 #include <vector>
 
 using namespace std;
@@ -35,21 +36,45 @@ void inline limit(int * value, int min, int max)
     }
 }
 
+// new maps start out sharing a single empty sector, which keeps a reference
+// to itself so it is never freed. it is created when the module is loaded,
+// so creating maps needs no locking.
+
+static MapSector * empty_sector = create_sector();
+
+inline MapData * create_map()
+{
+    MapData * map = new MapData;
+    for (int i = 0; i < SECTOR_COUNT; i++) {
+        map->sectors[i] = empty_sector;
+        add_reference(empty_sector);
+    }
+    memset(map->land, 0, sizeof(map->land));
+    map->supported = NULL;
+    map->supported_dirty = false;
+    map->search = NULL;
+    map->version = 0;
+    memset(map->sector_versions, 0, sizeof(map->sector_versions));
+    map->log = NULL;
+    return map;
+}
+
 MapData * load_vxl(unsigned char * v)
 {
-   MapData * map = new MapData;
+   MapData * map = create_map();
    if (v == NULL)
     return map;
    int x,y,z;
+   uint64_t column;
+   uint64_t color_mask;
+   int column_colors[MAP_Z];
    for (y=0; y < 512; ++y) {
       for (x=0; x < 512; ++x) {
-         for (z=0; z < 64; ++z) {
-            map->geometry[get_pos(x, y, z)] = 1;
-         }
+         column = FULL_COLUMN;
+         color_mask = 0;
          z = 0;
          for(;;) {
             int *color;
-            int i;
             int number_4byte_chunks = v[0];
             int top_color_start = v[1];
             int top_color_end   = v[2]; // inclusive
@@ -57,11 +82,12 @@ MapData * load_vxl(unsigned char * v)
             int bottom_color_end; // exclusive
             int len_top;
             int len_bottom;
-            for(i=z; i < top_color_start; i++)
-               map->geometry[get_pos(x, y, i)] = 0;
+            column &= ~get_column_range(z, top_color_start);
             color = (int *) (v+4);
-            for(z=top_color_start; z <= top_color_end; z++)
-               map->colors[get_pos(x, y, z)] = *color++;
+            for(z=top_color_start; z <= top_color_end; z++) {
+               color_mask |= COLUMN_BIT(z);
+               column_colors[z] = *color++;
+            }
             len_bottom = top_color_end - top_color_start + 1;
 
             // check for end of data marker
@@ -80,19 +106,27 @@ MapData * load_vxl(unsigned char * v)
             bottom_color_end   = v[3]; // aka air start
             bottom_color_start = bottom_color_end - len_top;
             for(z=bottom_color_start; z < bottom_color_end; ++z) {
-               map->colors[get_pos(x, y, z)] = *color++;
+               color_mask |= COLUMN_BIT(z);
+               column_colors[z] = *color++;
             }
          }
+         set_column(x, y, map, column);
+         // spans are appended in column order, so the colors array ends up
+         // laid out like the VXL data
+         int * span = set_color_mask(get_sector(x, y, map),
+            get_sector_column_pos(x, y), color_mask);
+         for (; color_mask != 0; color_mask &= color_mask - 1)
+            *span++ = column_colors[count_trailing_zeros(color_mask)];
       }
    }
+   // drop the spare capacity left over from growing the array
+   for (int i = 0; i < SECTOR_COUNT; i++) {
+      MapSector * sector = map->sectors[i];
+      vector<int>(sector->colors).swap(sector->colors);
+   }
    return map;
 }
 
-void inline delete_vxl(MapData * map)
-{
-    delete map;
-}
-
 struct Position {
     int x; 
     int y;
@@ -100,115 +134,335 @@ struct Position {
 };
 
 #define NODE_RESERVE_SIZE 250000
-static Position * nodes = NULL;
-static int node_pos;
-static int nodes_size;
-static set_type<int> marked;
 
-inline void push_back_node(int x, int y, int z)
+// scratch space for connectivity searches. every map gets its own, so
+// searches on different maps can run on different threads.
+
+struct MapSearch
+{
+    vector<Position> nodes;
+
+    // voxels visited by searches, in the same layout as the geometry. only
+    // the columns listed in marked_columns have bits set.
+    uint64_t marked[MAP_X * MAP_Y];
+    vector<int> marked_columns;
+
+    vector<Position> component;
+};
+
+inline MapSearch * get_search(MapData * map)
 {
-    nodes[node_pos].x = x;
-    nodes[node_pos].y = y;
-    nodes[node_pos].z = z;
-    node_pos++;
+    if (map->search == NULL) {
+        map->search = new MapSearch;
+        memset(map->search->marked, 0, sizeof(map->search->marked));
+        map->search->nodes.reserve(NODE_RESERVE_SIZE);
+    }
+    return map->search;
+}
+
+void inline delete_vxl(MapData * map)
+{
+    for (int i = 0; i < SECTOR_COUNT; i++)
+        release_sector(map->sectors[i]);
+    delete[] map->supported;
+    delete map->search;
+    delete map->log;
+    delete map;
 }
 
-inline const Position * pop_back_node()
+inline void push_back_node(MapSearch * search, int x, int y, int z)
 {
-    return &nodes[--node_pos];
+    Position node;
+    node.x = x;
+    node.y = y;
+    node.z = z;
+    search->nodes.push_back(node);
 }
 
-inline void add_node(int x, int y, int z, MapData * map)
+inline void add_node(int x, int y, int z, MapData * map, MapSearch * search)
 {
     if (x < 0 || x > 511 ||
         y < 0 || y > 511 ||
         z < 0 || z > 63)
         return;
-    if (!map->geometry[get_pos(x, y, z)])
+    if (!((get_column(x, y, map) >> z) & 1))
         return;
-    push_back_node(x, y, z);
+    push_back_node(search, x, y, z);
 }
 
-int check_node(int x, int y, int z, MapData * map, int destroy)
+// returns the cache of grounded voxels of the map, clearing it first if it
+// went stale
+
+inline uint64_t * get_supported(MapData * map)
 {
-    if (nodes == NULL) {
-        nodes = (Position*)malloc(sizeof(Position) * NODE_RESERVE_SIZE);
-        nodes_size = NODE_RESERVE_SIZE;
+    if (map->supported == NULL) {
+        map->supported = new uint64_t[MAP_X * MAP_Y];
+        map->supported_dirty = true;
+    }
+    if (map->supported_dirty) {
+        memset(map->supported, 0, sizeof(uint64_t) * MAP_X * MAP_Y);
+        map->supported_dirty = false;
     }
-    node_pos = 0;
+    return map->supported;
+}
+
+// a voxel is grounded if it is known to be, or if the column below it is
+// solid all the way down to the ground at z = 62
+
+inline int is_grounded(int x, int y, int z, MapData * map,
+                       uint64_t * supported)
+{
+    int i = get_column_pos(x, y);
+    if ((supported[i] >> z) & 1)
+        return 1;
+    return (~get_column(x, y, map) & get_column_range(z, 63)) == 0;
+}
+
+// the 3x3x3 block around a voxel as a 27-bit mask, with bit
+// dx + dy * 3 + dz * 9 for the voxel at (x + dx - 1, y + dy - 1, z + dz - 1)
+
+#define CUBE_SIZE 27
+#define CUBE_MASK 0x7FFFFFF
+#define CUBE_X_LOW 0x1249249 // dx == 0
+#define CUBE_X_HIGH (CUBE_X_LOW << 2)
+#define CUBE_Y_LOW 0x1C0E07 // dy == 0
+#define CUBE_Y_HIGH (CUBE_Y_LOW << 6)
+#define CUBE_CENTER (1 << 13)
+static const int cube_faces[6] = {4, 10, 16, 12, 14, 22};
+
+inline uint32_t get_solid_cube(int x, int y, int z, MapData * map)
+{
+    uint32_t cube = 0;
+    for (int dy = 0; dy < 3; dy++) {
+        for (int dx = 0; dx < 3; dx++) {
+            int column_x = x + dx - 1;
+            int column_y = y + dy - 1;
+            if (!is_valid_column(column_x, column_y))
+                continue;
+            uint64_t column = get_column(column_x, column_y, map);
+            uint32_t bits;
+            if (z == 0)
+                bits = (uint32_t)(column << 1) & 7;
+            else
+                bits = (uint32_t)(column >> (z - 1)) & 7;
+            int cell = dx + dy * 3;
+            cube |= ((bits & 1) << cell) | (((bits >> 1) & 1) << (cell + 9)) |
+                    (((bits >> 2) & 1) << (cell + 18));
+        }
+    }
+    return cube & ~CUBE_CENTER;
+}
+
+// returns 1 if the solid face neighbours of (x, y, z) are connected to each
+// other without going through (x, y, z) itself, looking only at the 3x3x3
+// block around it. if they are, removing that voxel can not disconnect any
+// two other voxels of the map.
+
+int neighbors_connected(int x, int y, int z, MapData * map)
+{
+    uint32_t solid = get_solid_cube(x, y, z, map);
+    uint32_t faces = 0;
+    for (int n = 0; n < 6; n++)
+        faces |= solid & (1 << cube_faces[n]);
+    if (faces == 0)
+        return 1;
+    uint32_t reached = faces & (~faces + 1);
+    for (;;) {
+        uint32_t next = reached |
+            ((reached & ~CUBE_X_HIGH) << 1) | ((reached & ~CUBE_X_LOW) >> 1) |
+            ((reached & ~CUBE_Y_HIGH) << 3) | ((reached & ~CUBE_Y_LOW) >> 3) |
+            (reached << 9) | (reached >> 9);
+        next &= solid;
+        if ((next & faces) == faces)
+            return 1;
+        if (next == reached)
+            return 0;
+        reached = next;
+    }
+}
+
+// flood fills the solid voxels connected to (x, y, z) until it reaches a
+// grounded voxel. returns 1 if it did, and leaves the visited voxels in
+// component.
+
+int find_ground(int x, int y, int z, MapData * map, MapSearch * search,
+                uint64_t * supported)
+{
+    vector<Position> & nodes = search->nodes;
+    uint64_t * marked = search->marked;
+    nodes.clear();
+    search->component.clear();
     
-    push_back_node(x, y, z);
+    push_back_node(search, x, y, z);
     
-    while (node_pos > 0) {
-        if (node_pos >= nodes_size - 6) {
-            nodes_size += NODE_RESERVE_SIZE;
-            nodes = (Position*)realloc((void*)nodes, 
-                sizeof(Position) * nodes_size);
-        }
-        const Position * current_node = pop_back_node();
-        z = current_node->z;
-        if (z >= 62) {
-            marked.clear();
+    while (!nodes.empty()) {
+        Position current_node = nodes.back();
+        nodes.pop_back();
+        z = current_node.z;
+        if (z >= 62)
+            return 1;
+        x = current_node.x;
+        y = current_node.y;
+        if (is_grounded(x, y, z, map, supported))
             return 1;
-        }
-        x = current_node->x;
-        y = current_node->y;
         
-        int i = get_pos(x, y, z);
+        int i = get_column_pos(x, y);
+        uint64_t bit = COLUMN_BIT(z);
 	
         // already visited?
-        pair<set_type<int>::iterator, bool> ret;
-        ret = marked.insert(i);
-        if (ret.second) {
-            add_node(x, y, z - 1, map);
-            add_node(x, y - 1, z, map);
-            add_node(x, y + 1, z, map);
-            add_node(x - 1, y, z, map);
-            add_node(x + 1, y, z, map);
-            add_node(x, y, z + 1, map);
-        }
+        if (marked[i] & bit)
+            continue;
+        if (marked[i] == 0)
+            search->marked_columns.push_back(i);
+        marked[i] |= bit;
+        search->component.push_back(current_node);
+
+        add_node(x, y, z - 1, map, search);
+        add_node(x, y - 1, z, map, search);
+        add_node(x, y + 1, z, map, search);
+        add_node(x - 1, y, z, map, search);
+        add_node(x + 1, y, z, map, search);
+        add_node(x, y, z + 1, map, search);
     }
+    return 0;
+}
 
-    // destroy the node's path!
-    
-    if (destroy) {
-        for (set_type<int>::const_iterator iter = marked.begin(); 
-             iter != marked.end(); ++iter)
-        {
-            map->geometry[*iter] = 0;
-            map->colors.erase(*iter);
+// checks if (x, y, z) is still connected to the bottom of the map. if it
+// is not, the floating voxels are destroyed when destroy is set and added
+// to collapsed if that is given.
+
+int check_component(int x, int y, int z, MapData * map, int destroy,
+                    vector<Position> * collapsed)
+{
+    uint64_t * supported = get_supported(map);
+    MapSearch * search = get_search(map);
+    vector<Position> & component = search->component;
+    int ret = find_ground(x, y, z, map, search, supported);
+    vector<Position>::const_iterator iter;
+    if (ret) {
+        // everything we visited is connected to the ground as well
+        for (iter = component.begin(); iter != component.end(); ++iter) {
+            int i = get_column_pos(iter->x, iter->y);
+            supported[i] |= COLUMN_BIT(iter->z);
+        }
+    } else if (destroy) {
+        // destroy the node's path! nothing else was connected to it, so
+        // the cache stays valid
+        for (iter = component.begin(); iter != component.end(); ++iter) {
+            set_solid(iter->x, iter->y, iter->z, map, false);
+            clear_colors(iter->x, iter->y, map, COLUMN_BIT(iter->z));
         }
+        if (collapsed != NULL)
+            collapsed->insert(collapsed->end(), component.begin(),
+                              component.end());
     }
-    
-    marked.clear();
-    return 0;
+    return ret;
 }
 
-// write_map/save_vxl function from stb/nothings - thanks a lot for the 
-// public-domain code!
+void clear_marked(MapData * map)
+{
+    MapSearch * search = get_search(map);
+    for (vector<int>::const_iterator iter = search->marked_columns.begin();
+         iter != search->marked_columns.end(); ++iter)
+    {
+        search->marked[*iter] = 0;
+    }
+    search->marked_columns.clear();
+}
 
-inline int is_surface(MapData * map, int x, int y, int z)
+int check_node(int x, int y, int z, MapData * map, int destroy)
 {
-   if (z == 0) return 1;
-   if (map->geometry[get_pos(x, y, z)]==0) return 0;
-   if (x   >   0 && map->geometry[get_pos(x-1, y, z)]==0) return 1;
-   if (x+1 < 512 && map->geometry[get_pos(x+1, y, z)]==0) return 1;
-   if (y   >   0 && map->geometry[get_pos(x, y-1, z)]==0) return 1;
-   if (y+1 < 512 && map->geometry[get_pos(x, y+1, z)]==0) return 1;
-   if (z   >   0 && map->geometry[get_pos(x, y, z-1)]==0) return 1;
-   if (z+1 <  64 && map->geometry[get_pos(x, y, z+1)]==0) return 1;
-   return 0;
+    int ret = check_component(x, y, z, map, destroy, NULL);
+    clear_marked(map);
+    return ret;
+}
+
+inline void check_neighbor(int x, int y, int z, MapData * map,
+                           vector<Position> * collapsed)
+{
+    if (z < 62 && get_solid(x, y, z, map))
+        check_component(x, y, z, map, 1, collapsed);
+}
+
+// checks the face neighbours of a removed voxel for floating blocks. if
+// they are still connected around it, they all share the same fate, so a
+// single search (or a single cache lookup) decides for all of them.
+
+void check_neighbors(int x, int y, int z, MapData * map,
+                     vector<Position> * collapsed)
+{
+    if (!neighbors_connected(x, y, z, map)) {
+        check_neighbor(x, y, z - 1, map, collapsed);
+        check_neighbor(x, y - 1, z, map, collapsed);
+        check_neighbor(x, y + 1, z, map, collapsed);
+        check_neighbor(x - 1, y, z, map, collapsed);
+        check_neighbor(x + 1, y, z, map, collapsed);
+        check_neighbor(x, y, z + 1, map, collapsed);
+        return;
+    }
+    if (z + 1 >= 62 && get_solid(x, y, z + 1, map))
+        return;
+    uint64_t * supported = get_supported(map);
+    int first = -1;
+    for (int n = 0; n < 6; n++) {
+        int face = cube_faces[n];
+        int nx = x + face % 3 - 1;
+        int ny = y + (face / 3) % 3 - 1;
+        int nz = z + face / 9 - 1;
+        if (!get_solid(nx, ny, nz, map))
+            continue;
+        if (is_grounded(nx, ny, nz, map, supported))
+            return;
+        if (first == -1)
+            first = face;
+    }
+    if (first == -1)
+        return;
+    int nx = x + first % 3 - 1;
+    int ny = y + (first / 3) % 3 - 1;
+    int nz = z + first / 9 - 1;
+    check_component(nx, ny, nz, map, 1, collapsed);
 }
 
-inline int get_write_color(MapData * map, int x, int y, int z)
+// removes the given voxels, then destroys everything that was only held up
+// by them. the voxels that were removed are appended to removed, and the
+// ones that fell down to collapsed.
+
+void destroy_nodes(MapData * map, const Position * points, int count,
+                   vector<Position> * removed, vector<Position> * collapsed)
 {
-    map_type<int, int>::const_iterator iter = map->colors.find(
-        get_pos(x, y, z));
-    if (iter == map->colors.end())
-        return DEFAULT_COLOR;
-    return iter->second;
+    int n;
+    size_t start = removed->size();
+    bool dirty = map->supported_dirty;
+    for (n = 0; n < count; n++) {
+        int x = points[n].x;
+        int y = points[n].y;
+        int z = points[n].z;
+        if (z >= 62 || !get_solid(x, y, z, map))
+            continue;
+        set_solid(x, y, z, map, false);
+        clear_colors(x, y, map, COLUMN_BIT(z));
+        if (map->supported != NULL) {
+            map->supported[get_column_pos(x, y)] &= ~COLUMN_BIT(z);
+            // if the neighbours are still connected around the voxel, no
+            // other voxel lost its connection to the ground
+            if (!neighbors_connected(x, y, z, map))
+                dirty = true;
+        }
+        removed->push_back(points[n]);
+    }
+    map->supported_dirty = dirty;
+    for (size_t i = start; i < removed->size(); i++) {
+        const Position * point = &(*removed)[i];
+        check_neighbors(point->x, point->y, point->z, map, collapsed);
+    }
+    clear_marked(map);
 }
 
+// write_map/save_vxl function from stb/nothings - thanks a lot for the 
+// public-domain code!
+
+
 inline void write_color(char ** out, int color)
 {
    // assume color is ARGB native, but endianness is unknown
@@ -223,124 +477,650 @@ inline void write_color(char ** out, int color)
    *out += 1;
 }
 
-char * out_global = 0;
+// the most a single column can take up: a span header for every other
+// voxel and a color for each of them
+
+#define MAX_COLUMN_SIZE (MAP_Z * 8)
+
+// writes the colors of voxels start up to (but not including) end. voxels
+// without a color get DEFAULT_COLOR.
+
+inline void write_colors(char ** out, const int * span, uint64_t mask,
+                         int start, int end)
+{
+   int n = get_color_index(mask, start);
+   for (int z = start; z < end; ++z) {
+      if ((mask >> z) & 1)
+         write_color(out, span[n++]);
+      else
+         write_color(out, DEFAULT_COLOR);
+   }
+}
+
+// writes the spans of a single column. the runs are found with bit scans
+// on the solid and surface masks of the column instead of testing each
+// voxel.
+
+inline char * write_column(char * out, MapData * map, int i, int j)
+{
+   uint64_t solid = get_column(i, j, map);
+   uint64_t surface = get_surface_mask(i, j, map);
+   MapSector * sector = get_sector(i, j, map);
+   int column = get_sector_column_pos(i, j);
+   uint64_t color_mask = sector->color_mask[column];
+   const int * span = get_color_span(sector, column);
+   int k = 0;
+   while (k < MAP_Z) {
+      int z;
+
+      int air_start;
+      int top_colors_start;
+      int top_colors_end; // exclusive
+      int bottom_colors_start;
+      int bottom_colors_end; // exclusive
+      int top_colors_len;
+      int bottom_colors_len;
+      int colors;
+      // find the air region
+      air_start = k;
+      k = find_bit(solid, k);
+      // find the top region
+      top_colors_start = k;
+      k = find_bit(~surface, k);
+      top_colors_end = k;
+
+      // now skip past the solid voxels
+      k = find_bit(~solid | surface, k);
+
+      // at the end of the solid voxels, we have colored voxels.
+      // in the "normal" case they're bottom colors; but it's
+      // possible to have air-color-solid-color-solid-color-air,
+      // which we encode as air-color-solid-0, 0-color-solid-air
+    
+      // so figure out if we have any bottom colors at this point
+      bottom_colors_start = k;
+
+      z = find_bit(~surface, k);
+
+      if (z == MAP_Z)
+         ; // in this case, the bottom colors of this span are empty, because we'l emit as top colors
+      else {
+         // otherwise, these are real bottom colors so we can write them
+         k = z;
+      }
+      bottom_colors_end = k;
+
+      // now we're ready to write a span
+      top_colors_len    = top_colors_end    - top_colors_start;
+      bottom_colors_len = bottom_colors_end - bottom_colors_start;
+
+      colors = top_colors_len + bottom_colors_len;
+
+      if (k == MAP_Z)
+      {
+         *out = 0;
+         out += 1;
+      }
+      else
+      {
+         *out = colors + 1;
+         out += 1;
+      }
+      *out = top_colors_start;
+      out += 1;
+      *out = top_colors_end - 1;
+      out += 1;
+      *out = air_start;
+      out += 1;
+
+      write_colors(&out, span, color_mask, top_colors_start,
+                   top_colors_end);
+      write_colors(&out, span, color_mask, bottom_colors_start,
+                   bottom_colors_end);
+   }
+   return out;
+}
+
+// appends the encoded column to data
 
-void create_temp()
+inline void append_column(vector<char> * data, MapData * map, int i, int j)
 {
-   if (out_global == 0)
-       out_global = (char *)malloc(10 * 1024 * 1024); // allocate 10 mb
+   char column[MAX_COLUMN_SIZE];
+   char * end = write_column(column, map, i, j);
+   data->insert(data->end(), column, end);
 }
 
-PyObject * save_vxl(MapData * map)
+// encodes rows y1 to y2 (exclusive). the columns are stored row by row, so
+// the rows of a map can be encoded separately and joined
+
+void save_vxl(MapData * map, vector<char> * data, int y1, int y2)
 {
-   int i,j,k;
-   create_temp();
-   char * out = out_global;
+   int i,j;
 
-   for (j=0; j < MAP_Y; ++j) {
+   for (j=y1; j < y2; ++j) {
       for (i=0; i < MAP_X; ++i) {
-         k = 0;
-         while (k < MAP_Z) {
-            int z;
-
-            int air_start;
-            int top_colors_start;
-            int top_colors_end; // exclusive
-            int bottom_colors_start;
-            int bottom_colors_end; // exclusive
-            int top_colors_len;
-            int bottom_colors_len;
-            int colors;
-            // find the air region
-            air_start = k;
-            while (k < MAP_Z && !map->geometry[get_pos(i, j, k)])
-               ++k;
-            // find the top region
-            top_colors_start = k;
-            while (k < MAP_Z && is_surface(map, i, j, k))
-               ++k;
-            top_colors_end = k;
-
-            // now skip past the solid voxels
-            while (k < MAP_Z && map->geometry[get_pos(i, j, k)] && 
-                   !is_surface(map, i,j,k))
-               ++k;
-
-            // at the end of the solid voxels, we have colored voxels.
-            // in the "normal" case they're bottom colors; but it's
-            // possible to have air-color-solid-color-solid-color-air,
-            // which we encode as air-color-solid-0, 0-color-solid-air
-          
-            // so figure out if we have any bottom colors at this point
-            bottom_colors_start = k;
-
-            z = k;
-            while (z < MAP_Z && is_surface(map, i,j, z))
-               ++z;
-
-            if (z == MAP_Z)
-               ; // in this case, the bottom colors of this span are empty, because we'l emit as top colors
-            else {
-               // otherwise, these are real bottom colors so we can write them
-               while (is_surface(map, i,j,k))  
-                  ++k;
-            }
-            bottom_colors_end = k;
+         append_column(data, map, i, j);
+      }
+   }
+}
 
-            // now we're ready to write a span
-            top_colors_len    = top_colors_end    - top_colors_start;
-            bottom_colors_len = bottom_colors_end - bottom_colors_start;
+// snapshots hold the sectors the way they are kept in memory: for each
+// sector, its geometry and color mask words, then the number of colors
+// and the colors of each column in order. loading one is a few copies per
+// sector instead of decoding every span of the VXL data.
 
-            colors = top_colors_len + bottom_colors_len;
+#define SNAPSHOT_MAGIC 0x4D535950 // "PYSM"
+#define SNAPSHOT_VERSION 1
 
-            if (k == MAP_Z)
-            {
-               *out = 0;
-               out += 1;
-            }
-            else
-            {
-               *out = colors + 1;
-               out += 1;
-            }
-            *out = top_colors_start;
-            out += 1;
-            *out = top_colors_end - 1;
-            out += 1;
-            *out = air_start;
-            out += 1;
-
-            for (z=0; z < top_colors_len; ++z)
-            {
-               write_color(&out, get_write_color(map, i, j, 
-                   top_colors_start + z));
-            }
-            for (z=0; z < bottom_colors_len; ++z)
-            {
-               write_color(&out, get_write_color(map, i, j, 
-                   bottom_colors_start + z));
-            }
-         }  
+struct SnapshotHeader
+{
+    uint32_t magic;
+    uint32_t version;
+    uint64_t size; // of the data after the header
+    uint64_t checksum;
+};
+
+uint64_t get_checksum(const char * data, size_t size)
+{
+    // FNV-1a over 64-bit words
+    uint64_t value = 14695981039346656037ULL;
+    uint64_t word;
+    size_t i;
+    for (i = 0; i + 8 <= size; i += 8) {
+        memcpy(&word, data + i, 8);
+        value = (value ^ word) * 1099511628211ULL;
+    }
+    for (; i < size; i++)
+        value = (value ^ (unsigned char)data[i]) * 1099511628211ULL;
+    return value;
+}
+
+inline void append_data(vector<char> * data, const void * value, size_t size)
+{
+    const char * start = (const char *)value;
+    data->insert(data->end(), start, start + size);
+}
+
+void save_snapshot(MapData * map, vector<char> * data)
+{
+   data->resize(sizeof(SnapshotHeader));
+   for (int i = 0; i < SECTOR_COUNT; i++) {
+      MapSector * sector = map->sectors[i];
+      append_data(data, sector->geometry, sizeof(sector->geometry));
+      append_data(data, sector->color_mask, sizeof(sector->color_mask));
+      uint32_t count = 0;
+      for (int j = 0; j < SECTOR_COLUMNS; j++)
+         count += count_bits(sector->color_mask[j]);
+      append_data(data, &count, sizeof(count));
+      for (int j = 0; j < SECTOR_COLUMNS; j++)
+         append_data(data, get_color_span(sector, j),
+                     count_bits(sector->color_mask[j]) * sizeof(int));
+   }
+   SnapshotHeader header;
+   header.magic = SNAPSHOT_MAGIC;
+   header.version = SNAPSHOT_VERSION;
+   header.size = data->size() - sizeof(SnapshotHeader);
+   header.checksum = get_checksum(&data->front() + sizeof(SnapshotHeader),
+                                  header.size);
+   memcpy(&data->front(), &header, sizeof(header));
+}
+
+// returns NULL if the data is not a valid snapshot
+
+MapData * load_snapshot(const char * data, size_t size)
+{
+   SnapshotHeader header;
+   if (size < sizeof(header))
+      return NULL;
+   memcpy(&header, data, sizeof(header));
+   data += sizeof(header);
+   size -= sizeof(header);
+   if (header.magic != SNAPSHOT_MAGIC || header.version != SNAPSHOT_VERSION ||
+       header.size != size || header.checksum != get_checksum(data, size))
+      return NULL;
+   const char * end = data + size;
+   MapData * map = create_map();
+   for (int i = 0; i < SECTOR_COUNT; i++) {
+      MapSector * sector = create_sector();
+      release_sector(map->sectors[i]);
+      map->sectors[i] = sector;
+      uint32_t count;
+      size_t words_size = sizeof(sector->geometry) +
+                          sizeof(sector->color_mask);
+      if ((size_t)(end - data) < words_size + sizeof(count)) {
+         delete_vxl(map);
+         return NULL;
+      }
+      memcpy(sector->geometry, data, sizeof(sector->geometry));
+      data += sizeof(sector->geometry);
+      memcpy(sector->color_mask, data, sizeof(sector->color_mask));
+      data += sizeof(sector->color_mask);
+      memcpy(&count, data, sizeof(count));
+      data += sizeof(count);
+      unsigned int offset = 0;
+      for (int j = 0; j < SECTOR_COLUMNS; j++) {
+         int colors = count_bits(sector->color_mask[j]);
+         sector->color_offset[j] = offset;
+         sector->color_capacity[j] = colors;
+         offset += colors;
       }
+      if (offset != count || (size_t)(end - data) / sizeof(int) < count) {
+         delete_vxl(map);
+         return NULL;
+      }
+      sector->colors.resize(count);
+      if (count != 0)
+         memcpy(&sector->colors.front(), data, count * sizeof(int));
+      data += count * sizeof(int);
+   }
+   for (int y = 0; y < MAP_Y; y++) {
+      for (int x = 0; x < MAP_X; x++)
+         update_land(x, y, map, get_column(x, y, map));
    }
-   return PyString_FromStringAndSize((char *)out_global, out - out_global);
+   return map;
 }
 
+// the copy shares all sectors with the original until either writes to them
+
 inline MapData * copy_map(MapData * map)
 {
-    return new MapData(*map);
+    MapData * copy = new MapData;
+    for (int i = 0; i < SECTOR_COUNT; i++) {
+        copy->sectors[i] = map->sectors[i];
+        add_reference(copy->sectors[i]);
+    }
+    memcpy(copy->land, map->land, sizeof(map->land));
+    copy->supported = NULL;
+    copy->supported_dirty = false;
+    copy->search = NULL;
+    copy->version = map->version;
+    memcpy(copy->sector_versions, map->sector_versions,
+           sizeof(map->sector_versions));
+    copy->log = NULL;
+    return copy;
+}
+
+// bytes of memory held by the map. sectors shared with other maps are
+// counted in full, the shared empty sector is not counted at all.
+
+size_t get_memory_size(MapData * map)
+{
+    size_t size = sizeof(MapData);
+    for (int i = 0; i < SECTOR_COUNT; i++) {
+        MapSector * sector = map->sectors[i];
+        if (sector == empty_sector)
+            continue;
+        size += sizeof(MapSector) + sector->colors.capacity() * sizeof(int);
+    }
+    if (map->supported != NULL)
+        size += MAP_X * MAP_Y * sizeof(uint64_t);
+    if (map->search != NULL)
+        size += sizeof(MapSearch) +
+                map->search->nodes.capacity() * sizeof(Position) +
+                map->search->marked_columns.capacity() * sizeof(int) +
+                map->search->component.capacity() * sizeof(Position);
+    if (map->log != NULL)
+        size += sizeof(MapChangeLog) +
+                map->log->columns.capacity() * sizeof(LoggedColumn);
+    return size;
 }
 
-struct Point2D
+// change logs
+
+void start_change_log(MapData * map)
 {
-    int x, y;
+    if (map->log != NULL)
+        return;
+    map->log = new MapChangeLog;
+    memset(map->log->marked, 0, sizeof(map->log->marked));
+    map->log->whole_map = false;
+}
+
+void stop_change_log(MapData * map)
+{
+    delete map->log;
+    map->log = NULL;
+}
+
+// for a map that replaces old: its versions continue from those of old, and
+// it keeps a change log if old did
+
+void replace_map(MapData * map, MapData * old)
+{
+    map->version = old->version + 1;
+    for (int i = 0; i < SECTOR_COUNT; i++)
+        map->sector_versions[i] = old->sector_versions[i] + 1;
+    if (old->log != NULL)
+        start_change_log(map);
+}
+
+unsigned int get_sector_version(MapData * map, int x, int y)
+{
+    return map->sector_versions[x + y * SECTORS_X];
+}
+
+// appends the voxels that were built, removed or recolored since the log was
+// last flushed, and empties the log. returns true without listing any if
+// the whole map may have changed.
+
+bool flush_change_log(MapData * map, vector<Position> * changed)
+{
+    MapChangeLog * log = map->log;
+    if (log == NULL)
+        return false;
+    if (log->whole_map) {
+        log->whole_map = false;
+        return true;
+    }
+    for (size_t n = 0; n < log->columns.size(); n++) {
+        LoggedColumn * column = &log->columns[n];
+        int x = column->x;
+        int y = column->y;
+        log->marked[y][x >> 6] &= ~COLUMN_BIT(x & 63);
+        MapSector * sector = get_sector(x, y, map);
+        int i = get_sector_column_pos(x, y);
+        uint64_t geometry = sector->geometry[i];
+        uint64_t mask = sector->color_mask[i];
+        uint64_t old_mask = column->color_mask;
+        uint64_t bits = geometry ^ column->geometry;
+        uint64_t check = geometry & column->geometry & (mask | old_mask);
+        int * span = get_color_span(sector, i);
+        for (; check != 0; check &= check - 1) {
+            int z = count_trailing_zeros(check);
+            int color = 0;
+            int old_color = 0;
+            if ((mask >> z) & 1)
+                color = span[get_color_index(mask, z)];
+            if ((old_mask >> z) & 1)
+                old_color = column->colors[get_color_index(old_mask, z)];
+            if (color != old_color)
+                bits |= COLUMN_BIT(z);
+        }
+        for (; bits != 0; bits &= bits - 1) {
+            Position position;
+            position.x = x;
+            position.y = y;
+            position.z = count_trailing_zeros(bits);
+            changed->push_back(position);
+        }
+    }
+    log->columns.clear();
+    return false;
+}
+
+// bit i is set for each sector of map that may differ from sector i of
+// other. sectors still shared between the two are known to be the same, so
+// holding on to a copy of a map tells which of its sectors have been written
+// to since.
+
+uint64_t get_changed_sectors(MapData * map, MapData * other)
+{
+    uint64_t changed = 0;
+    for (int i = 0; i < SECTOR_COUNT; i++)
+        if (map->sectors[i] != other->sectors[i])
+            changed |= (uint64_t)1 << i;
+    return changed;
+}
+
+// map diffs. the changes between two maps are listed column by column, x
+// major, from the top of each column down. the bottom layer (z = 63) is left
+// out, and surfaces are found the way VXLData.is_surface does it, with the
+// area outside the map counting as air.
+
+enum {
+    DIFF_DESTROY = 0, // solid voxel that is air in the other map
+    DIFF_BUILD, // air that is a hidden voxel in the other map
+    DIFF_SURFACE, // air that is a surface voxel in the other map
+    DIFF_REPLACE // surface voxel of the other map that is hidden here or
+                 // has another color
 };
 
+struct MapChange
+{
+    int color;
+    unsigned short x, y;
+    unsigned char z, type;
+};
+
+#define DIFF_COLUMN get_column_range(0, MAP_Z - 1)
+
+inline uint64_t get_column_air_edge(int x, int y, MapData * map)
+{
+    if (!is_valid_column(x, y))
+        return 0;
+    return get_column(x, y, map);
+}
+
+inline uint64_t get_exposed_mask(uint64_t column, int x, int y, MapData * map)
+{
+    uint64_t covered = (column << 1) & (column >> 1) &
+                       get_column_air_edge(x - 1, y, map) &
+                       get_column_air_edge(x + 1, y, map) &
+                       get_column_air_edge(x, y - 1, map) &
+                       get_column_air_edge(x, y + 1, map);
+    return column & ~covered;
+}
+
+inline void add_change(vector<MapChange> * changes, int x, int y, int z,
+                       int type, int color)
+{
+    MapChange change;
+    change.color = color;
+    change.x = x;
+    change.y = y;
+    change.z = z;
+    change.type = type;
+    changes->push_back(change);
+}
+
+// appends the changes that turn the region (x1, y1) - (x2, y2) of map into
+// that of other
+
+void get_map_diff(MapData * map, MapData * other, int x1, int y1, int x2,
+                  int y2, vector<MapChange> * changes)
+{
+    limit(&x1, 0, MAP_X);
+    limit(&x2, 0, MAP_X);
+    limit(&y1, 0, MAP_Y);
+    limit(&y2, 0, MAP_Y);
+    for (int x = x1; x < x2; x++)
+    for (int y = y1; y < y2; y++) {
+        uint64_t column = get_column(x, y, map);
+        uint64_t other_column = get_column(x, y, other);
+        uint64_t other_surface = get_exposed_mask(other_column, x, y, other);
+        uint64_t destroy = column & ~other_column & DIFF_COLUMN;
+        uint64_t build = other_column & ~column & DIFF_COLUMN;
+        uint64_t check = column & other_surface & DIFF_COLUMN;
+        if (check != 0) {
+            // solid in both maps, so only color and exposure can differ
+            MapSector * sector = get_sector(x, y, map);
+            MapSector * other_sector = get_sector(x, y, other);
+            int i = get_sector_column_pos(x, y);
+            uint64_t surface = get_exposed_mask(column, x, y, map);
+            uint64_t mask = sector->color_mask[i];
+            uint64_t other_mask = other_sector->color_mask[i];
+            build |= check & ~surface;
+            check &= surface;
+            if (sector == other_sector)
+                check = 0;
+            for (; check != 0; check &= check - 1) {
+                int z = count_trailing_zeros(check);
+                int color = 0;
+                int other_color = 0;
+                if ((mask >> z) & 1)
+                    color = get_color_span(sector, i)[
+                        get_color_index(mask, z)];
+                if ((other_mask >> z) & 1)
+                    other_color = get_color_span(other_sector, i)[
+                        get_color_index(other_mask, z)];
+                if ((color ^ other_color) & 0xFFFFFF)
+                    build |= COLUMN_BIT(z);
+            }
+        }
+        for (uint64_t changed = destroy | build; changed != 0;
+             changed &= changed - 1) {
+            int z = count_trailing_zeros(changed);
+            if ((destroy >> z) & 1) {
+                add_change(changes, x, y, z, DIFF_DESTROY, 0);
+                continue;
+            }
+            int type;
+            if (!((other_surface >> z) & 1))
+                type = DIFF_BUILD;
+            else if ((column >> z) & 1)
+                type = DIFF_REPLACE;
+            else
+                type = DIFF_SURFACE;
+            add_change(changes, x, y, z, type, get_color(x, y, z, other));
+        }
+    }
+}
+
+// applies changes made by get_map_diff. returns 0 if any of them is invalid,
+// in which case the changes before it have been made.
+
+int apply_map_diff(MapData * map, const MapChange * changes, size_t count)
+{
+    for (size_t i = 0; i < count; i++) {
+        const MapChange * change = &changes[i];
+        if (change->type > DIFF_REPLACE ||
+            !is_valid_position(change->x, change->y, change->z))
+            return 0;
+        set_point(change->x, change->y, change->z, map,
+                  change->type != DIFF_DESTROY, change->color);
+    }
+    return 1;
+}
+
+// regions. voxels are laid out x major, then y, then z, with one solid flag
+// and one color per voxel, from (x1, y1, z1) up to but not including
+// (x2, y2, z2). the region must lie within the map.
+
+inline int get_region_index(int x, int y, int x1, int y1, int y2, int depth)
+{
+    return ((x - x1) * (y2 - y1) + (y - y1)) * depth;
+}
+
+void get_region(MapData * map, int x1, int y1, int z1, int x2, int y2,
+                int z2, char * solid, int * colors)
+{
+    int depth = z2 - z1;
+    for (int x = x1; x < x2; x++)
+    for (int y = y1; y < y2; y++) {
+        int n = get_region_index(x, y, x1, y1, y2, depth);
+        uint64_t column = get_column(x, y, map);
+        MapSector * sector = get_sector(x, y, map);
+        int i = get_sector_column_pos(x, y);
+        uint64_t mask = sector->color_mask[i];
+        int * span = get_color_span(sector, i);
+        for (int z = z1; z < z2; z++, n++) {
+            solid[n] = (column >> z) & 1;
+            if ((mask >> z) & 1)
+                colors[n] = span[get_color_index(mask, z)];
+            else
+                colors[n] = 0;
+        }
+    }
+}
+
+// if colors is NULL, voxels keep their colors and new voxels get
+// DEFAULT_COLOR
+
+void set_region(MapData * map, int x1, int y1, int z1, int x2, int y2,
+                int z2, const char * solid, const int * colors)
+{
+    int depth = z2 - z1;
+    uint64_t range = get_column_range(z1, z2);
+    bool removed_any = false;
+    for (int x = x1; x < x2; x++)
+    for (int y = y1; y < y2; y++) {
+        int n = get_region_index(x, y, x1, y1, y2, depth);
+        uint64_t bits = 0;
+        for (int z = z1; z < z2; z++)
+            if (solid[n + z - z1])
+                bits |= COLUMN_BIT(z);
+        uint64_t old_column = get_column(x, y, map);
+        uint64_t column = (old_column & ~range) | bits;
+        uint64_t removed = old_column & ~column;
+        if (column != old_column)
+            set_column(x, y, map, column);
+        if (removed != 0) {
+            clear_colors(x, y, map, removed);
+            removed_any = true;
+        }
+        int i = get_sector_column_pos(x, y);
+        uint64_t mask = get_sector(x, y, map)->color_mask[i];
+        uint64_t colored = column & ~old_column;
+        if (colors != NULL) {
+            // voxels without a color read as 0, so they only need one if
+            // it is something else
+            colored = 0;
+            for (uint64_t check = bits; check != 0; check &= check - 1) {
+                int z = count_trailing_zeros(check);
+                if (colors[n + z - z1] != 0 || ((mask >> z) & 1))
+                    colored |= COLUMN_BIT(z);
+            }
+        }
+        if (colored == 0)
+            continue;
+        MapSector * sector = get_writable_sector(x, y, map);
+        mask |= colored;
+        int * span = set_color_mask(sector, i, mask);
+        for (; colored != 0; colored &= colored - 1) {
+            int z = count_trailing_zeros(colored);
+            int color = DEFAULT_COLOR;
+            if (colors != NULL)
+                color = colors[n + z - z1];
+            span[get_color_index(mask, z)] = color;
+        }
+    }
+    if (removed_any)
+        forget_support(map);
+}
+
 inline unsigned int random(unsigned int a, unsigned int b, float value)
 {
     return (unsigned int)(value * (b - a) + a);
 }
 
+// the given word of land row y, with only the columns from x1 up to (but
+// not including) x2 left in it
+
+inline uint64_t get_land_word(MapData * map, int y, int word, int x1, int x2)
+{
+    int start = word * 64;
+    int word_x1 = x1 > start ? x1 - start : 0;
+    int word_x2 = x2 < start + 64 ? x2 - start : 64;
+    return map->land[y][word] & get_column_range(word_x1, word_x2);
+}
+
+inline int count_row_land(MapData * map, int y, int x1, int x2)
+{
+    int count = 0;
+    for (int word = x1 >> 6; word <= (x2 - 1) >> 6; word++)
+        count += count_bits(get_land_word(map, y, word, x1, x2));
+    return count;
+}
+
+// number of land columns from (x1, y1) up to (but not including) (x2, y2)
+
+int count_land(int x1, int y1, int x2, int y2, MapData * map)
+{
+    limit(&x1, 0, MAP_X);
+    limit(&y1, 0, MAP_Y);
+    limit(&x2, 0, MAP_X);
+    limit(&y2, 0, MAP_Y);
+    if (x2 <= x1)
+        return 0;
+    int count = 0;
+    for (int y = y1; y < y2; y++)
+        count += count_row_land(map, y, x1, x2);
+    return count;
+}
+
+// picks a uniformly random land column in the rectangle, or a random
+// column if there is no land in it
+
 inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
                              float random_1, float random_2,
                              int * end_x, int * end_y)
@@ -349,27 +1129,114 @@ inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
     limit(&y1, 0, 511);
     limit(&x2, 0, 511);
     limit(&y2, 0, 511);
-    vector<Point2D> items;
-    int size = 0;
-    int x, y;
-    for(x = x1; x < x2; x++){
-        for(y = y1; y < y2; y++) {
-            if (map->geometry[get_pos(x, y, 62)]) {
-                Point2D item;
-                item.x = x;
-                item.y = y;
-                items.push_back(item);
-                size += 1;
-            }
-        }
-    }
+    int size = count_land(x1, y1, x2, y2, map);
     if (size == 0) {
         *end_x = random(x1, x2, random_1);
         *end_y = random(y1, y2, random_2);
-    } else {
-        Point2D item = items[random(0, size, random_1)];
-        *end_x = item.x;
-        *end_y = item.y;
+        return;
+    }
+    int index = random(0, size, random_1);
+    // random_1 close to 1.0 can round up to size
+    if (index >= size)
+        index = size - 1;
+    for (int y = y1; y < y2; y++) {
+        for (int word = x1 >> 6; word <= (x2 - 1) >> 6; word++) {
+            uint64_t land = get_land_word(map, y, word, x1, x2);
+            int count = count_bits(land);
+            if (index >= count) {
+                index -= count;
+                continue;
+            }
+            for (; index > 0; index--)
+                land &= land - 1;
+            *end_x = word * 64 + count_trailing_zeros(land);
+            *end_y = y;
+            return;
+        }
+    }
+}
+
+// fills data with the color of the top voxel of each column, or of the
+// voxels at height z if it is not -1. see VXLData.get_overview.
+
+inline unsigned int get_pixel(unsigned int color, unsigned int a, int rgba)
+{
+    if (!rgba)
+        return (color & 0x00FFFFFF) | (a << 24);
+    unsigned int b = color & 0xFF;
+    unsigned int g = (color & 0xFF00) >> 8;
+    unsigned int r = (color & 0xFF0000) >> 16;
+    return r | (g << 8) | (b << 16) | (a << 24);
+}
+
+// overviews are images of the columns from (x1, y1) up to but not including
+// (x2, y2), y major. with z = -1 every pixel has the color of the top of its
+// column, otherwise that of layer z, transparent where the layer is not
+// solid.
+
+void get_overview(MapData * map, int z, int rgba, int x1, int y1, int x2,
+                  int y2, unsigned int * data)
+{
+    for (int y = y1; y < y2; y++)
+    for (int x = x1; x < x2; x++) {
+        MapSector * sector = get_sector(x, y, map);
+        int i = get_sector_column_pos(x, y);
+        uint64_t column = sector->geometry[i];
+        uint64_t mask = sector->color_mask[i];
+        unsigned int a = 255;
+        int current_z = z;
+        if (z == -1) {
+            current_z = find_bit(column, 0);
+            if (current_z == MAP_Z)
+                current_z = 0;
+        } else if (z < 0 || z >= MAP_Z) {
+            *data++ = get_pixel(0, 0, rgba);
+            continue;
+        } else if (!((column >> z) & 1))
+            a = 0;
+        unsigned int color = 0;
+        if ((mask >> current_z) & 1)
+            color = get_color_span(sector, i)[
+                get_color_index(mask, current_z)];
+        *data++ = get_pixel(color, a, rgba);
+    }
+}
+
+// all 64 layers one after the other, the same as get_overview for each z
+
+void get_layers(MapData * map, int rgba, unsigned int * data)
+{
+    for (int y = 0; y < MAP_Y; y++)
+    for (int x = 0; x < MAP_X; x++) {
+        MapSector * sector = get_sector(x, y, map);
+        int i = get_sector_column_pos(x, y);
+        uint64_t column = sector->geometry[i];
+        uint64_t mask = sector->color_mask[i];
+        int * span = get_color_span(sector, i);
+        unsigned int * out = data + y * MAP_X + x;
+        for (int z = 0; z < MAP_Z; z++, out += MAP_X * MAP_Y) {
+            unsigned int color = 0;
+            if ((mask >> z) & 1)
+                color = *span++;
+            unsigned int a = ((column >> z) & 1) ? 255 : 0;
+            *out = get_pixel(color, a, rgba);
+        }
+    }
+}
+
+// the reverse of get_overview for layer z, with rgba off. pixels that are
+// not fully opaque are cleared.
+
+void set_layer(MapData * map, int z, const unsigned int * data)
+{
+    log_whole_map(map);
+    for (int y = 0; y < MAP_Y; y++)
+    for (int x = 0; x < MAP_X; x++) {
+        unsigned int color = *data++;
+        if ((color >> 24) != 255)
+            set_point(x, y, z, map, 0, 0);
+        else
+            set_point(x, y, z, map, 1, color);
     }
 }
 
@@ -394,13 +1261,20 @@ void update_shadows(MapData * map)
 {
     int x, y, z;
     int a;
-    unsigned int color;
-    for (map_type<int, int>::iterator iter = map->colors.begin();
-        iter != map->colors.end(); ++iter) {
-        get_xyz(iter->first, &x, &y, &z);
-        color = iter->second;
-        a = sunblock(map, x, y, z);
-        iter->second = (color & 0x00FFFFFF) | (a << 24);
+    log_whole_map(map);
+    for (y = 0; y < MAP_Y; y++) {
+        for (x = 0; x < MAP_X; x++) {
+            MapSector * sector = get_writable_sector(x, y, map);
+            int i = get_sector_column_pos(x, y);
+            uint64_t mask = sector->color_mask[i];
+            int * span = get_color_span(sector, i);
+            for (; mask != 0; mask &= mask - 1) {
+                z = count_trailing_zeros(mask);
+                a = sunblock(map, x, y, z);
+                *span = (*span & 0x00FFFFFF) | (a << 24);
+                span++;
+            }
+        }
     }
 }
 
@@ -425,11 +1299,10 @@ void delete_map_generator(MapGenerator * generator)
     delete generator;
 }
 
-PyObject * get_generator_data(MapGenerator * generator, int columns)
+void get_generator_data(MapGenerator * generator, int columns,
+                        vector<char> * data)
 {
-   int i, j, k;
-   create_temp();
-   char * out = out_global;
+   int i, j;
    int column = 0;
    MapData * map = generator->map;
 
@@ -439,88 +1312,7 @@ PyObject * get_generator_data(MapGenerator * generator, int columns)
          {
              goto done;
          }
-         k = 0;
-         while (k < MAP_Z) {
-            int z;
-
-            int air_start;
-            int top_colors_start;
-            int top_colors_end; // exclusive
-            int bottom_colors_start;
-            int bottom_colors_end; // exclusive
-            int top_colors_len;
-            int bottom_colors_len;
-            int colors;
-            // find the air region
-            air_start = k;
-            while (k < MAP_Z && !map->geometry[get_pos(i, j, k)])
-               ++k;
-            // find the top region
-            top_colors_start = k;
-            while (k < MAP_Z && is_surface(map, i, j, k))
-               ++k;
-            top_colors_end = k;
-
-            // now skip past the solid voxels
-            while (k < MAP_Z && map->geometry[get_pos(i, j, k)] && 
-                   !is_surface(map, i,j,k))
-               ++k;
-
-            // at the end of the solid voxels, we have colored voxels.
-            // in the "normal" case they're bottom colors; but it's
-            // possible to have air-color-solid-color-solid-color-air,
-            // which we encode as air-color-solid-0, 0-color-solid-air
-          
-            // so figure out if we have any bottom colors at this point
-            bottom_colors_start = k;
-
-            z = k;
-            while (z < MAP_Z && is_surface(map, i,j, z))
-               ++z;
-
-            if (z == MAP_Z)
-               ; // in this case, the bottom colors of this span are empty, because we'l emit as top colors
-            else {
-               // otherwise, these are real bottom colors so we can write them
-               while (is_surface(map, i,j,k))  
-                  ++k;
-            }
-            bottom_colors_end = k;
-
-            // now we're ready to write a span
-            top_colors_len    = top_colors_end    - top_colors_start;
-            bottom_colors_len = bottom_colors_end - bottom_colors_start;
-
-            colors = top_colors_len + bottom_colors_len;
-
-            if (k == MAP_Z)
-            {
-               *out = 0;
-               out += 1;
-            }
-            else
-            {
-               *out = colors + 1;
-               out += 1;
-            }
-            *out = top_colors_start;
-            out += 1;
-            *out = top_colors_end - 1;
-            out += 1;
-            *out = air_start;
-            out += 1;
-
-            for (z=0; z < top_colors_len; ++z)
-            {
-               write_color(&out, get_write_color(map, i, j, 
-                   top_colors_start + z));
-            }
-            for (z=0; z < bottom_colors_len; ++z)
-            {
-               write_color(&out, get_write_color(map, i, j, 
-                   bottom_colors_start + z));
-            }
-         }
+         append_column(data, map, i, j);
          column++;
       }
    generator->x = 0;
@@ -528,5 +1320,4 @@ PyObject * get_generator_data(MapGenerator * generator, int columns)
 done:
    generator->x = i;
    generator->y = j;
-   return PyString_FromStringAndSize((char *)out_global, out - out_global);
-}
+}
\ No newline at end of file
@@ -1,10 +1,16 @@
 #ifndef VXL_C_H
 #define VXL_C_H
 
-#include <bitset>
+#include <stdint.h>
+#include <string.h>
+#include <vector>
 #include <boost/unordered_map.hpp>
 #include <boost/unordered_set.hpp>
 
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
+
 #define map_type boost::unordered_map
 #define set_type boost::unordered_set
 
@@ -12,15 +18,173 @@
 #define MAP_Y 512
 #define MAP_Z 64
 #define get_pos(x, y, z) ((x) + (y) * MAP_Y + (z) * MAP_X * MAP_Y)
+#define get_column_pos(x, y) ((x) + (y) * MAP_Y)
 #define DEFAULT_COLOR 0xFF674028
 
+// each (x, y) column is a single 64-bit word, with bit z set if the voxel
+// at height z is solid
+
+#define COLUMN_BIT(z) ((uint64_t)1 << (z))
+#define FULL_COLUMN (~(uint64_t)0)
+
+// the map is split into sectors of SECTOR_SIZE x SECTOR_SIZE columns.
+// sectors are reference counted and shared between copies of a map, and a
+// shared sector is only duplicated when one of the maps writes to it (see
+// get_writable_sector), so copying a map only copies the sector pointers.
+
+#define SECTOR_SHIFT 6
+#define SECTOR_SIZE (1 << SECTOR_SHIFT)
+#define SECTOR_MASK (SECTOR_SIZE - 1)
+#define SECTOR_COLUMNS (SECTOR_SIZE * SECTOR_SIZE)
+#define SECTORS_X (MAP_X / SECTOR_SIZE)
+#define SECTORS_Y (MAP_Y / SECTOR_SIZE)
+#define SECTOR_COUNT (SECTORS_X * SECTORS_Y)
+#define get_sector_pos(x, y) (((x) >> SECTOR_SHIFT) + \
+                              ((y) >> SECTOR_SHIFT) * SECTORS_X)
+#define get_sector_column_pos(x, y) (((x) & SECTOR_MASK) + \
+                                     ((y) & SECTOR_MASK) * SECTOR_SIZE)
+
+// colors are kept per column, like in the VXL format itself. color_mask
+// has bit z set if the voxel at height z has a color, and the colors of a
+// column are stored in ascending z order in a span of the sector's colors
+// array, starting at color_offset and with room for color_capacity entries.
+// a span that has to grow is moved to the end of the array with some room
+// to spare, and the array is compacted once the abandoned slots make up
+// half of it.
+
+#define COLOR_SPAN_SLACK 4
+
+struct MapSector
+{
+    int references;
+    uint64_t geometry[SECTOR_COLUMNS];
+    uint64_t color_mask[SECTOR_COLUMNS];
+    unsigned int color_offset[SECTOR_COLUMNS];
+    unsigned char color_capacity[SECTOR_COLUMNS];
+    std::vector<int> colors;
+    unsigned int free_colors;
+};
+
+// land has bit x & 63 of land[y][x >> 6] set if the voxel at (x, y, 62)
+// is solid, so land in a rectangle can be counted and sampled a row at a
+// time. the geometry writers below keep it up to date.
+
+#define LAND_WORDS (MAP_X / 64)
+
+// supported caches which voxels are known to be connected to the bottom of
+// the map, one bit per voxel like the geometry. it is only allocated once
+// blocks get destroyed, and it is thrown away (by setting supported_dirty)
+// whenever voxels are removed in a way that could disconnect others.
+
+// version goes up with every write to the map, and sector_versions[i] with
+// every write to sector i. they only ever increase, so a changed version
+// means the map (or sector) may have changed since it was last looked at.
+
+// while the map has a change log, the state of every column is saved before
+// it is first written to, so the voxels that actually changed can be listed
+// afterwards (see flush_change_log). writes to the whole map, or to more
+// than MAX_LOGGED_COLUMNS columns, only mark the whole map as changed
+// instead, since listing them would cost more than looking at the map again.
+
+#define MAX_LOGGED_COLUMNS 4096
+
+struct LoggedColumn
+{
+    int x, y;
+    uint64_t geometry, color_mask;
+    int colors[MAP_Z];
+};
+
+struct MapChangeLog
+{
+    std::vector<LoggedColumn> columns;
+    uint64_t marked[MAP_Y][LAND_WORDS];
+    bool whole_map;
+};
+
 struct MapData
 {
-    std::bitset<MAP_X * MAP_Y * MAP_Z> geometry;
-    // char geometry[MAP_X * MAP_Y * MAP_Z];
-    map_type<int, int> colors;
+    MapSector * sectors[SECTOR_COUNT];
+    uint64_t land[MAP_Y][LAND_WORDS];
+    uint64_t * supported;
+    bool supported_dirty;
+    struct MapSearch * search;
+    unsigned int version;
+    unsigned int sector_versions[SECTOR_COUNT];
+    MapChangeLog * log;
 };
 
+#if defined(__GNUC__)
+
+int inline count_trailing_zeros(uint64_t value)
+{
+    return __builtin_ctzll(value);
+}
+
+int inline count_leading_zeros(uint64_t value)
+{
+    return __builtin_clzll(value);
+}
+
+int inline count_bits(uint64_t value)
+{
+    return __builtin_popcountll(value);
+}
+
+#else
+
+int inline count_bits(uint64_t value)
+{
+    value = value - ((value >> 1) & 0x5555555555555555ULL);
+    value = (value & 0x3333333333333333ULL) +
+            ((value >> 2) & 0x3333333333333333ULL);
+    value = (value + (value >> 4)) & 0x0F0F0F0F0F0F0F0FULL;
+    return (int)((value * 0x0101010101010101ULL) >> 56);
+}
+
+int inline count_trailing_zeros(uint64_t value)
+{
+    return count_bits((value & (~value + 1)) - 1);
+}
+
+int inline count_leading_zeros(uint64_t value)
+{
+    value |= value >> 1;
+    value |= value >> 2;
+    value |= value >> 4;
+    value |= value >> 8;
+    value |= value >> 16;
+    value |= value >> 32;
+    return 64 - count_bits(value);
+}
+
+#endif
+
+// returns the index of the first set bit in value at or after start, or
+// MAP_Z if there is none
+
+int inline find_bit(uint64_t value, int start)
+{
+    if (start >= MAP_Z)
+        return MAP_Z;
+    value >>= start;
+    if (value == 0)
+        return MAP_Z;
+    return start + count_trailing_zeros(value);
+}
+
+// mask with the bits from start up to (but not including) end set
+
+uint64_t inline get_column_range(int start, int end)
+{
+    if (start >= end)
+        return 0;
+    uint64_t mask = FULL_COLUMN << start;
+    if (end < MAP_Z)
+        mask &= ~(FULL_COLUMN << end);
+    return mask;
+}
+
 void inline get_xyz(int pos, int* x, int* y, int* z)
 {
     *x = pos % MAP_Y;
@@ -33,11 +197,163 @@ int inline is_valid_position(int x, int y, int z)
     return x >= 0 && x < 512 && y >= 0 && y < 512 && z >= 0 && z < 64;
 }
 
+int inline is_valid_column(int x, int y)
+{
+    return x >= 0 && x < 512 && y >= 0 && y < 512;
+}
+
+inline MapSector * create_sector()
+{
+    MapSector * sector = new MapSector;
+    sector->references = 1;
+    memset(sector->geometry, 0, sizeof(sector->geometry));
+    memset(sector->color_mask, 0, sizeof(sector->color_mask));
+    memset(sector->color_offset, 0, sizeof(sector->color_offset));
+    memset(sector->color_capacity, 0, sizeof(sector->color_capacity));
+    sector->free_colors = 0;
+    return sector;
+}
+
+// sectors can be shared between maps used on different threads, so their
+// reference counts are changed atomically
+
+#if defined(__GNUC__)
+
+int inline add_sector_references(MapSector * sector, int value)
+{
+    return __sync_add_and_fetch(&sector->references, value);
+}
+
+#else
+
+int inline add_sector_references(MapSector * sector, int value)
+{
+    return _InterlockedExchangeAdd((volatile long *)&sector->references,
+                                   value) + value;
+}
+
+#endif
+
+void inline add_reference(MapSector * sector)
+{
+    add_sector_references(sector, 1);
+}
+
+void inline release_sector(MapSector * sector)
+{
+    if (add_sector_references(sector, -1) == 0)
+        delete sector;
+}
+
+inline MapSector * get_sector(int x, int y, MapData * map)
+{
+    return map->sectors[get_sector_pos(x, y)];
+}
+
+inline int * get_color_span(MapSector * sector, int i)
+{
+    if (sector->colors.empty())
+        return NULL;
+    return &sector->colors[0] + sector->color_offset[i];
+}
+
+inline void log_whole_map(MapData * map)
+{
+    MapChangeLog * log = map->log;
+    if (log == NULL || log->whole_map)
+        return;
+    log->whole_map = true;
+    std::vector<LoggedColumn>().swap(log->columns);
+    memset(log->marked, 0, sizeof(log->marked));
+}
+
+inline void log_column(int x, int y, MapData * map)
+{
+    if (map->log->whole_map)
+        return;
+    uint64_t * marked = &map->log->marked[y][x >> 6];
+    if (*marked & COLUMN_BIT(x & 63))
+        return;
+    if (map->log->columns.size() >= MAX_LOGGED_COLUMNS) {
+        log_whole_map(map);
+        return;
+    }
+    *marked |= COLUMN_BIT(x & 63);
+    MapSector * sector = get_sector(x, y, map);
+    int i = get_sector_column_pos(x, y);
+    map->log->columns.push_back(LoggedColumn());
+    LoggedColumn * column = &map->log->columns.back();
+    column->x = x;
+    column->y = y;
+    column->geometry = sector->geometry[i];
+    column->color_mask = sector->color_mask[i];
+    int count = count_bits(column->color_mask);
+    if (count > 0)
+        memcpy(column->colors, get_color_span(sector, i), count * sizeof(int));
+}
+
+// returns the sector containing (x, y) for writing, first giving this map
+// its own copy if the sector is shared with other maps. every write to the
+// map goes through here.
+
+inline MapSector * get_writable_sector(int x, int y, MapData * map)
+{
+    int pos = get_sector_pos(x, y);
+    map->version++;
+    map->sector_versions[pos]++;
+    if (map->log != NULL)
+        log_column(x, y, map);
+    MapSector ** sector = &map->sectors[pos];
+    if ((*sector)->references > 1) {
+        MapSector * copy = new MapSector(**sector);
+        copy->references = 1;
+        release_sector(*sector);
+        *sector = copy;
+    }
+    return *sector;
+}
+
+uint64_t inline get_column(int x, int y, MapData * map)
+{
+    return get_sector(x, y, map)->geometry[get_sector_column_pos(x, y)];
+}
+
+uint64_t inline get_column_wrap(int x, int y, MapData * map)
+{
+    return get_column(x & 511, y & 511, map);
+}
+
+// columns outside the map count as fully solid, as they do for the surface
+// checks in the VXL encoder
+
+uint64_t inline get_column_solid_edge(int x, int y, MapData * map)
+{
+    if (!is_valid_column(x, y))
+        return FULL_COLUMN;
+    return get_column(x, y, map);
+}
+
+void inline update_land(int x, int y, MapData * map, uint64_t column)
+{
+    uint64_t * word = &map->land[y][x >> 6];
+    if ((column >> 62) & 1)
+        *word |= COLUMN_BIT(x & 63);
+    else
+        *word &= ~COLUMN_BIT(x & 63);
+}
+
+void inline set_column(int x, int y, MapData * map, uint64_t value)
+{
+    get_writable_sector(x, y, map)->geometry[get_sector_column_pos(x, y)] =
+        value;
+    update_land(x, y, map, value);
+}
+
 int inline get_solid(int x, int y, int z, MapData * map)
 {
     if (!is_valid_position(x, y, z))
         return 0;
-    return map->geometry[get_pos(x, y, z)];
+    return (get_column(x, y, map) >> z) & 1;
 }
 
 int inline get_solid_wrap(int x, int y, int z, MapData * map)
@@ -46,61 +362,214 @@ int inline get_solid_wrap(int x, int y, int z, MapData * map)
         return 0;
     else if (z >= 64)
         return 1;
-    return map->geometry[get_pos(x & 511, y & 511, z)];
+    return (get_column_wrap(x, y, map) >> z) & 1;
+}
+
+void inline set_solid(int x, int y, int z, MapData * map, bool solid)
+{
+    uint64_t * column = &get_writable_sector(x, y, map)->geometry[
+        get_sector_column_pos(x, y)];
+    if (solid)
+        *column |= COLUMN_BIT(z);
+    else
+        *column &= ~COLUMN_BIT(z);
+    update_land(x, y, map, *column);
+}
+
+// mask of the solid voxels in a column that are exposed to air. z = 0 is
+// always exposed, and the bottom of the map is not.
+
+uint64_t inline get_surface_mask(int x, int y, MapData * map)
+{
+    uint64_t column = get_column(x, y, map);
+    uint64_t covered = (column << 1) &
+                       ((column >> 1) | COLUMN_BIT(MAP_Z - 1)) &
+                       get_column_solid_edge(x - 1, y, map) &
+                       get_column_solid_edge(x + 1, y, map) &
+                       get_column_solid_edge(x, y - 1, map) &
+                       get_column_solid_edge(x, y + 1, map);
+    return column & ~covered;
+}
+
+// first solid voxel from start and downwards, or 0 if there is none
+
+int inline get_top(int x, int y, int start, MapData * map)
+{
+    if (!is_valid_column(x, y))
+        return 0;
+    if (start < 0)
+        start = 0;
+    int z = find_bit(get_column(x, y, map), start);
+    if (z == MAP_Z)
+        return 0;
+    return z;
+}
+
+// height right above the solid run that reaches the bottom of the column,
+// or 0 if the whole column is solid
+
+int inline get_bottom_height(int x, int y, MapData * map)
+{
+    if (!is_valid_column(x, y))
+        return MAP_Z;
+    uint64_t air = ~get_column(x, y, map);
+    if (air == 0)
+        return 0;
+    return MAP_Z - count_leading_zeros(air);
+}
+
+// index of the color of voxel z within its column span
+
+int inline get_color_index(uint64_t mask, int z)
+{
+    return count_bits(mask & (COLUMN_BIT(z) - 1));
 }
 
 int inline get_color(int x, int y, int z, MapData * map)
 {
-    map_type<int, int>::const_iterator iter = map->colors.find(
-        get_pos(x, y, z));
-    if (iter == map->colors.end())
+    MapSector * sector = get_sector(x, y, map);
+    int i = get_sector_column_pos(x, y);
+    uint64_t mask = sector->color_mask[i];
+    if (!((mask >> z) & 1))
         return 0;
-    return iter->second;
+    return get_color_span(sector, i)[get_color_index(mask, z)];
 }
 
-void inline set_point(int x, int y, int z, MapData * map, bool solid, int color)
+// appends a span with room for the given number of colors to the colors
+// array of the sector and returns its offset
+
+unsigned int inline add_color_span(MapSector * sector, int i, int capacity)
 {
-    int i = get_pos(x, y, z);
-    map->geometry[i] = solid;
-    if (!solid)
-        map->colors.erase(i);
-    else
-        map->colors[i] = color;
+    unsigned int offset = sector->colors.size();
+    if (capacity > MAP_Z)
+        capacity = MAP_Z;
+    sector->colors.resize(offset + capacity);
+    sector->color_offset[i] = offset;
+    sector->color_capacity[i] = capacity;
+    return offset;
 }
 
-void inline set_column_solid(int x, int y, int z_start, int z_end,
-    MapData * map, bool solid)
+void inline compact_colors(MapSector * sector)
+{
+    std::vector<int> colors;
+    colors.reserve(sector->colors.size() - sector->free_colors);
+    for (int i = 0; i < SECTOR_COLUMNS; i++) {
+        int count = count_bits(sector->color_mask[i]);
+        int * span = get_color_span(sector, i);
+        sector->color_offset[i] = colors.size();
+        sector->color_capacity[i] = count;
+        colors.insert(colors.end(), span, span + count);
+    }
+    sector->colors.swap(colors);
+    sector->free_colors = 0;
+}
+
+// changes the set of colored voxels in column i of the sector to mask,
+// keeping the colors of the voxels that stay colored. returns the column
+// span, in which the colors of new voxels are left undefined.
+
+inline int * set_color_mask(MapSector * sector, int i, uint64_t mask)
 {
-    int i = get_pos(x, y, z_start);
-    int i_end = get_pos(x, y, z_end);
-    if (!solid)
-    {
-        while (i <= i_end)
-        {
-            map->geometry[i] = solid;
-            i += MAP_X * MAP_Y;
+    uint64_t old_mask = sector->color_mask[i];
+    if (mask == old_mask)
+        return get_color_span(sector, i);
+    int count = count_bits(mask);
+    int old_count = count_bits(old_mask);
+    int old_colors[MAP_Z];
+    if (old_count > 0)
+        memcpy(old_colors, get_color_span(sector, i),
+               old_count * sizeof(int));
+    if (count > sector->color_capacity[i]) {
+        // columns that get their first colors (e.g. when loading) are
+        // packed tightly, only columns that are being built on get slack
+        int capacity = count;
+        if (sector->color_capacity[i] > 0)
+            capacity += COLOR_SPAN_SLACK;
+        sector->free_colors += sector->color_capacity[i];
+        if (sector->free_colors > sector->colors.size() / 2) {
+            sector->color_mask[i] = 0;
+            compact_colors(sector);
         }
+        add_color_span(sector, i, capacity);
     }
-    else
-    {
-        while (i <= i_end)
-        {
-            map->geometry[i] = solid;
-            i += MAP_X * MAP_Y;
+    sector->color_mask[i] = mask;
+    int * span = get_color_span(sector, i);
+    int n = 0;
+    int old_n = 0;
+    for (uint64_t bits = mask | old_mask; bits != 0; bits &= bits - 1) {
+        uint64_t bit = bits & (~bits + 1);
+        if (mask & bit) {
+            if (old_mask & bit)
+                span[n] = old_colors[old_n];
+            n++;
         }
+        if (old_mask & bit)
+            old_n++;
     }
+    return span;
+}
+
+void inline set_color(int x, int y, int z, MapData * map, int color)
+{
+    MapSector * sector = get_writable_sector(x, y, map);
+    int i = get_sector_column_pos(x, y);
+    uint64_t mask = sector->color_mask[i] | COLUMN_BIT(z);
+    int * span = set_color_mask(sector, i, mask);
+    span[get_color_index(mask, z)] = color;
+}
+
+void inline clear_colors(int x, int y, MapData * map, uint64_t mask)
+{
+    int i = get_sector_column_pos(x, y);
+    if (!(get_sector(x, y, map)->color_mask[i] & mask))
+        return;
+    MapSector * sector = get_writable_sector(x, y, map);
+    set_color_mask(sector, i, sector->color_mask[i] & ~mask);
+}
+
+void inline forget_support(MapData * map)
+{
+    map->supported_dirty = true;
+}
+
+void inline set_point(int x, int y, int z, MapData * map, bool solid, int color)
+{
+    set_solid(x, y, z, map, solid);
+    if (!solid) {
+        clear_colors(x, y, map, COLUMN_BIT(z));
+        forget_support(map);
+    } else
+        set_color(x, y, z, map, color);
+}
+
+void inline set_column_solid(int x, int y, int z_start, int z_end,
+    MapData * map, bool solid)
+{
+    uint64_t mask = get_column_range(z_start, z_end + 1);
+    uint64_t * column = &get_writable_sector(x, y, map)->geometry[
+        get_sector_column_pos(x, y)];
+    if (!solid) {
+        *column &= ~mask;
+        forget_support(map);
+    } else
+        *column |= mask;
+    update_land(x, y, map, *column);
 }
 
 void inline set_column_color(int x, int y, int z_start, int z_end,
     MapData * map, int color)
 {
-    int i = get_pos(x, y, z_start);
-    int i_end = get_pos(x, y, z_end);
-    while (i <= i_end)
-    {
-        map->colors[i] = color;
-        i += MAP_X * MAP_Y;
-    }
+    uint64_t range = get_column_range(z_start, z_end + 1);
+    if (range == 0)
+        return;
+    MapSector * sector = get_writable_sector(x, y, map);
+    int i = get_sector_column_pos(x, y);
+    uint64_t mask = sector->color_mask[i] | range;
+    int * span = set_color_mask(sector, i, mask);
+    int start = get_color_index(mask, z_start);
+    int end = start + count_bits(range);
+    for (int n = start; n < end; n++)
+        span[n] = color;
 }
 
 #endif /* VXL_C_H */
\ No newline at end of file
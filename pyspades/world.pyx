@@ -24,6 +24,10 @@ from pyspades.constants import *
 cdef extern from "math.h":
     double fabs(double x)
 
+cdef extern from "Python.h":
+    char * PyByteArray_AS_STRING(object bytearray)
+    int _PyFloat_Pack4(double x, unsigned char * p, int le)
+
 cdef extern from "common_c.h":
     struct LongVector:
         int x, y, z
@@ -64,6 +68,7 @@ cdef extern from "world_c.cpp":
     int move_grenade(GrenadeType * grenade)
     
 from libc.math cimport sqrt
+from libc.string cimport memset
 
 cdef inline bint can_see(VXLData map, float x1, float y1, float z1,
     float x2, float y2, float z2):
@@ -393,4 +398,29 @@ cpdef cube_line(x1, y1, z1, x2, y2, z2):
     cdef list points = []
     for i in xrange(size):
         points.append((array[i].x, array[i].y, array[i].z))
-    return points
\ No newline at end of file
+    return points
+
+cdef inline void write_vector(unsigned char * data, Vector * vector):
+    _PyFloat_Pack4(vector.x, data, 1)
+    _PyFloat_Pack4(vector.y, data + 4, 1)
+    _PyFloat_Pack4(vector.z, data + 8, 1)
+
+def write_world_update(list characters, bytearray data):
+    """Writes the position and orientation of each character to data, in
+    the format of WorldUpdate.data. None is written as zeros."""
+    cdef Py_ssize_t count = len(characters)
+    cdef Py_ssize_t i
+    cdef unsigned char * c_data
+    cdef Character character
+    if len(data) != count * 24:
+        raise ValueError('data should be %s bytes' % (count * 24))
+    c_data = <unsigned char *>PyByteArray_AS_STRING(data)
+    for i in range(count):
+        item = characters[i]
+        if item is None:
+            memset(c_data, 0, 24)
+        else:
+            character = item
+            write_vector(c_data, &character.player.p)
+            write_vector(c_data + 12, &character.player.f)
+        c_data += 24
\ No newline at end of file
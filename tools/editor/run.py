@@ -652,23 +652,20 @@ class MapEditor(QtGui.QMainWindow):
     
     def apply_default(self):
         self.map = VXLData()
-        self.slice_map(show_dialog = False)
+        self.slice_map()
         bottom_layer = self.layers[63]
         bottom_layer.fill(WATER_PEN.rgba())
         bottom_layer.dirty = True
         self.edit_widget.map_updated(self.map)
         self.set_dirty(False)
     
-    def slice_map(self, show_dialog = True):
+    def slice_map(self):
         self.layers = []
-        if show_dialog:
-            progress = progress_dialog(self.edit_widget, 0, 63, 'Slicing...', 
-                can_abort = False)
+        data = self.map.get_layers()
+        size = len(data) / 64
         for z in xrange(0, 64):
-            if show_dialog:
-                progress.setValue(z)
-            self.layers.append(MapImage(self.map.get_overview(z), 512, 512,
-                QImage.Format_ARGB32))
+            self.layers.append(MapImage(data[z * size:(z + 1) * size], 512,
+                512, QImage.Format_ARGB32))
     
     def save_selected(self):
         if self.filename is None: